@@ -1,17 +1,29 @@
 import os
 import time
 import operator
+import signal
+import threading
+import resource
+import Queue
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+from io import BytesIO
+from collections import deque, OrderedDict
 
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 
 from scipy import interpolate
+from scipy.io import wavfile
 from sklearn.utils import shuffle
-from sklearn.metrics import confusion_matrix
 import itertools
 
 import pickle
+import json
+import struct
+import cProfile
 
 import theano
 import theano.tensor as T
@@ -23,27 +35,34 @@ from lasagne import init
 from lasagne import objectives
 from lasagne import updates
 from lasagne import regularization
-train_path = 'dataset/train/src/'
-
-test_path = 'dataset/val/src/'
-
-classes = [c for c in sorted(os.listdir(train_path))]
 
 RANDOM_SEED = 1337
 RANDOM = np.random.RandomState(RANDOM_SEED)
 lasagne_random.set_rng(RANDOM)
 
+#Run mode (only used if bird.py runs as script, importing it has no side effects)
+MODE = 'train' #'train', 'finetune', 'predict', 'score', 'serve', 'embed', 'export', 'tta', 'benchmark' or 'split'
+
 #Dataset params
 DATASET_PATH = 'dataset/train/spec_44.1/'
 NOISE_PATH = 'dataset/train/noise/'
+DATASET_INDEX = 'dataset/train/dataset_index.pkl' #persisted folder listings, only changed folders get re-scanned
 MAX_SAMPLES = None                                                  
 MAX_VAL_SAMPLES = None
 MAX_CLASSES = None                                                   
-MIN_SAMPLES_PER_CLASS = -1                                          
-MAX_SAMPLES_PER_CLASS = 1500                                       
+MIN_SAMPLES_PER_CLASS = -1 #per epoch, smaller classes get drawn more than once
+MAX_SAMPLES_PER_CLASS = 1500 #per epoch, larger classes get a new random subset every epoch
+CLASS_WEIGHTS = {} #class: samples per epoch relative to class size (default 1.0), applied before min/max
 SORT_CLASSES_ALPHABETICALLY = True                               
-VAL_SPLIT = 0.05                                                    
+VAL_SPLIT = 0.05 #only used without split manifest
+SPLIT_MANIFEST = 'dataset/train/split_manifest.pkl' #validation recordings (see split mode), used instead of VAL_SPLIT if it exists
+SPLIT_RATIO = 0.1 #share of recordings per class in the split manifest (at least 1, 2 for classes with 13-20 recordings)
 USE_CACHE = False                                                  
+CACHE_SIZE = 2048 #cache budget in MB (shared by all workers)
+NOISE_CACHE_SIZE = 256 #pinned cache budget for noise samples in MB (shared by all workers)
+USE_SHARD = False #pack decoded images into memory-mapped shards once and read from there
+SHARD_PATH = 'dataset/train/shard/'
+AUDIO_INPUT = False #compute spectrograms of wav files in train_path on the fly instead of reading images from DATASET_PATH
 
 #Ensamble params
 SAMPLE_RANGE = [None, None]
@@ -52,6 +71,7 @@ CLASS_NAMES = []
 MULTI_LABEL = False
 VAL_HAS_MULTI_LABEL = False
 MEAN_TARGETS_PER_IMAGE = 2
+MAX_MIXING_ROUNDS = 3 #upper bound of vectorized mixing passes per batch
 IM_SIZE = (512, 256) #(width, height)
 IM_DIM = 1
 IM_AUGMENTATION = {#'type':[probability, value]
@@ -63,6 +83,8 @@ IM_AUGMENTATION = {#'type':[probability, value]
                    #'flip': [0.25, 1]
                    }
 
+VECTORIZED_AUGMENTATION = True #augment whole batches at once instead of single images
+RUN_BENCHMARKS = False #measure augmentation throughput and batch assembly time before training
 SAME_CLASS_AUGMENTATION = True
 MAX_SAME_CLASS_COMBINATIONS = 5
 
@@ -80,10 +102,24 @@ L2_WEIGHT = 1e-4
 OPTIMIZER='adam' #'adam' or 'nesterov'
 EPOCHS = 55
 RANDOMIZE_TRAIN_SET = True
+NUM_WORKERS = 4 #background processes for image loading and augmentation, 0 loads batches in main process
+PREFETCH_BATCHES = 10 #number of ready batches we keep in memory
+TRAIN_PROCESSES = 1 #data-parallel training, every batch is split across these processes (1 trains in main process)
+
+#Validation and early stopping params
+VALIDATION_INTERVAL = 1 #validate every n epochs (the last epoch always gets validated)
+VAL_SUBSAMPLE = 1.0 #share of VAL used for validations before the last epoch
+BEST_METRIC = 'val_accuracy' #'val_accuracy' or 'val_loss', decides best params, early stopping and plateaus
+MIN_DELTA = 0.0 #smaller changes of BEST_METRIC are no improvement
+EARLY_STOPPING_PATIENCE = None #stop after this many validations without improvement, None = off
+LR_ON_PLATEAU = False #LEARNING_RATE schedule jumps to the next epoch key after LR_PLATEAU_PATIENCE validations without improvement
+LR_PLATEAU_PATIENCE = 3
 
 #Confusion matrix params
 CONFMATRIX_MAX_CLASSES = 100
 NORMALIZE_CONFMATRIX = True
+CONFMATRIX_BACKGROUND = True #render plots in a background process
+CONFMATRIX_SNAPSHOT_ONLY = False #only plot on SNAPSHOT_EPOCHS
 
 #Model import/export params
 MODEL_PATH = 'model/'
@@ -94,12 +130,132 @@ RUN_NAME = 'TUCMI_Example_Run'
 SIMPLE_LOG_MODE = True
 SNAPSHOT_EPOCHS = [10, 20, 30, 40, 50] #[-1] saves after every epoch
 SAVE_AFTER_INTERRUPT = True
+ASYNC_SNAPSHOTS = True #write checkpoints in a background thread
+
+#Profiling params
+PROFILE_LOG = True #per epoch stage timings, queue depth, cache hit rate and throughput as jsonl in MODEL_PATH
+PROFILE_BATCHES = None #(epoch, first batch, last batch) of train batches we run cProfile on
+
+#Benchmark params (MODE = 'benchmark', runs on a synthetic dataset)
+BENCHMARK_PATH = 'benchmark/' #synthetic dataset and json results
+BENCHMARK_CLASSES = 10
+BENCHMARK_SAMPLES_PER_CLASS = 20
+BENCHMARK_REPEATS = 5 #timed calls per stage (after one warm-up call)
+BENCHMARK_MODEL_TYPES = [1, 2, 3]
+
+#Head fine-tune params (MODE = 'finetune', needs PRETRAINED_MODEL, LOAD_OUTPUT_LAYER = False for new classes)
+FEATURE_PATH = 'features/' #cached conv features of TRAIN and VAL
+FEATURE_COPIES = 3 #passes over TRAIN, every pass after the first one is augmented
+FINETUNE_EPOCHS = 30
+FINETUNE_LEARNING_RATE = 0.001
+
+#Spectrogram params (inference and AUDIO_INPUT)
+SPEC_WINLEN = 0.05 #seconds per fft frame
+SPEC_WINSTEP = 0.0097 #seconds between frames (= one spectrogram column)
+SPEC_NFFT = 840
+SPEC_TYPE = 'linear' #'linear' (lowest IM_SIZE[1] fft bins) or 'mel' (IM_SIZE[1] mel bands)
+SPEC_WINDOW = 'rect' #'rect' (like our pre-rendered images) or 'hann'
+SPEC_FMIN = 0 #mel only
+SPEC_FMAX = None #mel only, None = half the sample rate
+
+#Inference params (MODE = 'predict', needs PRETRAINED_MODEL)
+INFERENCE_FILES = [] #wav files or spectrogram images of any length
+PREDICTION_PATH = 'predictions/'
+WINDOW_OVERLAP = 0.5 #overlap of consecutive windows
+SEGMENT_LENGTH = 10 #seconds per pooled segment
+POOLING = 'mean' #'mean' or 'max' of window predictions
+TOP_K = 5 #number of classes we report per segment and file
+INFERENCE_MODEL = None #exported inference model in MODEL_PATH (see export mode), None uses the full net
+ENSEMBLE_MODELS = [] #checkpoints in MODEL_PATH we run together, class subsets are merged (overrides INFERENCE_MODEL)
+ENSEMBLE_WORKERS = 0 #processes running ensemble members concurrently, 0 runs them one after another
+TTA_VARIANTS = 1 #test-time augmentation variants per window (frequency rolls, time shifts, flips), 1 = off
+TTA_POOLING = 'mean' #'mean' or 'max' over variants
+TTA_TIME_SHIFT = 0.1 #max. time shift of variants (share of window width), frequency rolls use IM_AUGMENTATION['roll']
+TTA_FLIP = False #time-flipped variants (only if the net was trained with flips)
+TTA_EVAL_VARIANTS = [1, 2, 4, 8] #MODE = 'tta' reports accuracy and latency on VAL for these numbers of variants
+
+#Batch scoring params (MODE = 'score', resumes where a killed job stopped)
+SCORE_INPUT_PATH = 'dataset/score/' #walked recursively for wav files and spectrogram images
+SCORE_OUTPUT_PATH = 'scores/'
+SCORE_SHARD_FILES = 10000 #files per output shard
+SCORE_FULL_VECTORS = False #store all class scores (float16) next to the top-k
+SCORE_READERS = 4 #processes reading and decoding input files, 0 reads in main process
+
+#Scoring server params (MODE = 'serve', POST wav files or spectrogram images to /predict, GET /metrics)
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8080
+SERVE_MAX_WAIT = 10 #ms a micro-batch waits for more windows before it runs
+SERVE_METRICS_WINDOW = 10000 #number of latest requests used for latency percentiles
+
+#Embedding params (MODE = 'embed' writes embeddings of all TRAIN and VAL samples and a k-nn index, needs PRETRAINED_MODEL)
+EMBEDDING_PATH = 'embeddings/'
+EMBEDDING_DTYPE = 'float16' #'float16' or 'float32' rows of the memory-mapped embedding matrix
+EMBEDDING_NORMALIZE = True #unit length rows, inner products are cosine similarities
+EMBEDDING_QUERIES = [] #spectrogram images we look up the nearest neighbours for
+KNN_INDEX = 'ivf' #'exact' searches all rows (blocked matrix multiply), 'ivf' only the rows of the closest k-means cells
+KNN_CELLS = 1024 #k-means cells of the ivf index
+KNN_PROBES = 8 #cells searched per query
+KNN_BLOCK = 65536 #rows per matrix multiply
+KNN_NEIGHBOURS = 10
+DUPLICATE_SIMILARITY = 0.98 #pairs within a cell above this similarity are reported as near-duplicates, None = off
+
+#Inference export params (MODE = 'export', needs PRETRAINED_MODEL)
+INFERENCE_PRECISION = 'int8' #'float32', 'float16' or 'int8' weights of exported model
+EXPORT_TOLERANCE = 1.0 #max. top-1 validation accuracy drop in % of exported model
+
+#################### DATASET INDEX ######################
+def loadDatasetIndex():
+
+    #{folder: {'mtime':folder mtime, 'files':{name:(size, mtime)}}}
+    if os.path.exists(DATASET_INDEX):
+        with open(DATASET_INDEX, 'rb') as f:
+            return pickle.load(f)
+    else:
+        return {}
+
+def saveDatasetIndex(index):
+
+    #write to temp file first, a killed process should not leave a broken index
+    if not os.path.exists(os.path.dirname(DATASET_INDEX)):
+        os.makedirs(os.path.dirname(DATASET_INDEX))
+    with open(DATASET_INDEX + '.tmp', 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(DATASET_INDEX + '.tmp', DATASET_INDEX)
+
+def scanFolder(index, folder):
+
+    #adding, removing or renaming files changes the folder mtime, so unchanged folders don't need a listdir
+    mtime = os.stat(folder).st_mtime
+    entry = index.get(folder)
+    if entry != None and entry['mtime'] == mtime:
+        return sorted(entry['files']), False
+
+    #we only stat files we have not seen before
+    old = entry['files'] if entry != None else {}
+    files = {}
+    for name in os.listdir(folder):
+        if name in old:
+            files[name] = old[name]
+        else:
+            st = os.stat(os.path.join(folder, name))
+            files[name] = (st.st_size, st.st_mtime)
+    index[folder] = {'mtime':mtime, 'files':files}
 
+    return sorted(files), True
 
 def parseDataset():
 
+    #folder listings from the persisted index
+    index = loadDatasetIndex()
+    changed = False
+
+    #images or wav files?
+    root = train_path if AUDIO_INPUT else DATASET_PATH
+
     #we use subfolders as class labels
-    classes = [folder for folder in sorted(os.listdir(DATASET_PATH)) if folder in CLASS_NAMES or len(CLASS_NAMES) == 0]
+    folders, c_changed = scanFolder(index, root)
+    changed = changed or c_changed
+    classes = [folder for folder in folders if folder in CLASS_NAMES or len(CLASS_NAMES) == 0]
     if not SORT_CLASSES_ALPHABETICALLY:
         classes = shuffle(classes, random_state=RANDOM)
     classes = classes[:MAX_CLASSES]
@@ -112,7 +268,19 @@ def parseDataset():
     tclasses = []
     sample_count = {}
     for c in classes:
-        c_images = [os.path.join(DATASET_PATH, c, path) for path in os.listdir(os.path.join(DATASET_PATH, c))][:MAX_SAMPLES_PER_CLASS]
+        files, c_changed = scanFolder(index, os.path.join(root, c))
+        changed = changed or c_changed
+        if AUDIO_INPUT:
+
+            #every IM_SIZE chunk of a wav file is a sample
+            c_images = []
+            for path in files:
+                if path.lower().endswith('.wav'):
+                    chunks, c_changed = getAudioChunkCount(index, os.path.join(root, c), path)
+                    changed = changed or c_changed
+                    c_images += [(os.path.join(root, c, path) + '@' + str(i * IM_SIZE[0]), c) for i in xrange(chunks)]
+        else:
+            c_images = [(os.path.join(root, c, path), c) for path in files]
 
         #add images to dataset if number of samples in specific range (important only for ensemble training)
         if not SAMPLE_RANGE[1] or len(c_images) in range(SAMPLE_RANGE[0], SAMPLE_RANGE[1]):
@@ -120,24 +288,36 @@ def parseDataset():
             images += c_images
             tclasses.append(c)
 
-            #Do we want to correct class imbalance?
-            #This will affect validation scores as we use some samples in TRAIN and VAL
-            while sample_count[c] < MIN_SAMPLES_PER_CLASS:
-                images += [c_images[RANDOM.randint(0, len(c_images))]]
-                sample_count[c] += 1
+            #class imbalance is handled by the sampler, every sample is listed once
 
     classes = tclasses    
 
+    #samples are (path, class index) tuples, this way we never need to parse labels from paths again
+    class_index = dict([(c, i) for i, c in enumerate(classes)])
+    images = [(path, class_index[c]) for path, c in images]
+
     #shuffle image paths
     images = shuffle(images, random_state=RANDOM)[:MAX_SAMPLES]
 
-    #validation split
-    vsplit = int(len(images) * VAL_SPLIT)
-    train = images[:-vsplit]
-    val = images[-vsplit:][:MAX_VAL_SAMPLES]
+    #validation split: recordings from the split manifest or a share of all samples
+    manifest = loadSplitManifest()
+    if manifest != None:
+        is_val = [isValidationSample(path, classes[i], manifest) for path, i in images]
+        train = [s for s, v in zip(images, is_val) if not v]
+        val = [s for s, v in zip(images, is_val) if v][:MAX_VAL_SAMPLES]
+    else:
+        vsplit = int(len(images) * VAL_SPLIT)
+        train = images[:-vsplit]
+        val = images[-vsplit:][:MAX_VAL_SAMPLES]
 
     #load noise samples
-    noise = shuffle([os.path.join(NOISE_PATH, path) for path in os.listdir(NOISE_PATH)], random_state=RANDOM)
+    files, c_changed = scanFolder(index, NOISE_PATH)
+    changed = changed or c_changed
+    noise = shuffle([os.path.join(NOISE_PATH, path) for path in files], random_state=RANDOM)
+
+    #persist updated folder listings
+    if changed:
+        saveDatasetIndex(index)
 
     #show classes if needed for testing
     #print classes
@@ -150,52 +330,544 @@ def parseDataset():
     print "NOISE SAMPLES:", len(noise)
 
     return classes, train, val, noise
-CLASSES, TRAIN, VAL, NOISE = parseDataset()
-NUM_CLASSES = len(CLASSES)
-CACHE = {}
-def openImage(path, useCache=USE_CACHE):
 
-    global CACHE
+#dataset is parsed on first use
+CLASSES = None
+TRAIN = None
+VAL = None
+NOISE = None
+NUM_CLASSES = None
+def loadDataset():
+
+    global CLASSES
+    global TRAIN
+    global VAL
+    global NOISE
+    global NUM_CLASSES
+
+    if CLASSES == None:
+        CLASSES, TRAIN, VAL, NOISE = parseDataset()
+        NUM_CLASSES = len(CLASSES)
+
+        #pack dataset into shards (uint8 images only)
+        if USE_SHARD and not AUDIO_INPUT:
+            packDataset()
+
+    return CLASSES, TRAIN, VAL, NOISE
+
+####################### SAMPLER #########################
+#every epoch draws sample ids per class, TRAIN itself never changes
+#(small classes are drawn repeatedly, large classes get a new subset every epoch, so all samples get used eventually)
+def getBalancedSampleIds(split, shuffled=True):
+
+    #sample ids grouped by class
+    labels = np.array([index for _, index in split], dtype='int32')
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.searchsorted(labels[order], np.arange(NUM_CLASSES + 1))
+
+    ids = []
+    for c in xrange(NUM_CLASSES):
+        c_ids = order[bounds[c]:bounds[c + 1]]
+        if c_ids.shape[0] == 0:
+            continue
+
+        #samples of this class in this epoch
+        n = int(round(c_ids.shape[0] * CLASS_WEIGHTS.get(CLASSES[c], 1.0)))
+        n = max(n, MIN_SAMPLES_PER_CLASS)
+        if MAX_SAMPLES_PER_CLASS != None:
+            n = min(n, MAX_SAMPLES_PER_CLASS)
+
+        #all samples once plus random duplicates or a random subset
+        if n > c_ids.shape[0]:
+            ids.append(np.concatenate([c_ids, RANDOM.choice(c_ids, n - c_ids.shape[0])]))
+        else:
+            ids.append(RANDOM.choice(c_ids, n, replace=False))
 
-    #using a dict {path:image} cache saves some time after first epoch
-    #but may consume a lot of RAM
-    if path in CACHE:
-        return CACHE[path]
+    ids = np.concatenate(ids).astype('int32')
+    if shuffled:
+        RANDOM.shuffle(ids)
     else:
+        ids.sort()
 
-        #open image
-        img = cv2.imread(path)
+    return ids
 
-        #DEBUG
-        try:
-            h, w = img.shape[:2]
-        except:
-            print "IMAGE NONE-TYPE:", path
+###################### PROFILING ########################
+#cheap wall clock timers and counters per stage, workers send their timings back with every batch
+#(worker stages are summed over all workers, so they can exceed the epoch time)
+TIMINGS = {}
+EPOCH_TIMINGS = {}
+PROFILER = None
+def addTiming(stage, start, count=1):
+
+    t = TIMINGS.setdefault(stage, [0.0, 0])
+    t[0] += time.time() - start
+    t[1] += count
+
+def addCounter(name, value):
+
+    #counters are [sum, count] just like timings
+    t = TIMINGS.setdefault(name, [0.0, 0])
+    t[0] += value
+    t[1] += 1
+
+def popTimings():
+
+    global TIMINGS
+
+    timings = TIMINGS
+    TIMINGS = {}
+
+    return timings
+
+def addTimings(timings):
+
+    #sum up timings of all processes
+    for k in timings:
+        t = EPOCH_TIMINGS.setdefault(k, [0.0, 0])
+        t[0] += timings[k][0]
+        t[1] += timings[k][1]
+
+def getProfileName():
 
-        #original image dimensions
-        try:
-            h, w, d = img.shape
+    return MODEL_PATH + "birdCLEF_" + RUN_NAME + "_profile"
+
+def logEpochProfile(epoch, duration, train_samples, val_samples):
+
+    global EPOCH_TIMINGS
+
+    #timings of the main process
+    addTimings(popTimings())
+
+    #one json line per epoch
+    stages = {}
+    for k in sorted(EPOCH_TIMINGS):
+        if k != 'queue_depth':
+            stages[k] = {'seconds':EPOCH_TIMINGS[k][0], 'count':EPOCH_TIMINGS[k][1], 'ms_per_item':EPOCH_TIMINGS[k][0] * 1000.0 / max(1, EPOCH_TIMINGS[k][1])}
+    depth = EPOCH_TIMINGS.get('queue_depth', [0.0, 0])
+    lookups = EPOCH_CACHE_STATS.get('hits', 0) + EPOCH_CACHE_STATS.get('misses', 0)
+    entry = {'epoch':epoch,
+             'time':time.time(),
+             'duration':duration,
+             'train_samples':train_samples,
+             'val_samples':val_samples,
+             'samples_per_sec':(train_samples + val_samples) / max(duration, 1e-8),
+             'queue_depth':depth[0] / max(1, depth[1]),
+             'cache_hit_rate':EPOCH_CACHE_STATS.get('hits', 0) / float(lookups) if lookups > 0 else None,
+             'stages':stages}
+    EPOCH_TIMINGS = {}
+
+    #short summary: time waiting for batches vs. time in theano
+    print "SAMPLES/S:", int(entry['samples_per_sec']),
+    print "WAIT:", (int(stages.get('wait', {'seconds':0})['seconds'] * 10) / 10.0), "s",
+    print "TRAIN STEP:", (int(stages.get('train_step', {'seconds':0})['seconds'] * 10) / 10.0), "s",
+    print "QUEUE DEPTH:", (int(entry['queue_depth'] * 10) / 10.0)
+
+    if PROFILE_LOG:
+        if not os.path.exists(MODEL_PATH):
+            os.makedirs(MODEL_PATH)
+        with open(getProfileName() + '.jsonl', 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    return entry
+
+def profileBatch(epoch, batch):
+
+    global PROFILER
+
+    #cProfile only runs for the chosen batch range of the main process
+    if PROFILE_BATCHES == None or epoch != PROFILE_BATCHES[0]:
+        return
+    if batch == PROFILE_BATCHES[1] and PROFILER == None:
+        print "\nSTARTING PROFILER..."
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
+    elif batch == PROFILE_BATCHES[2]:
+        stopProfiler(epoch)
+
+def stopProfiler(epoch):
+
+    global PROFILER
+
+    if PROFILER != None:
+        PROFILER.disable()
+        if not os.path.exists(MODEL_PATH):
+            os.makedirs(MODEL_PATH)
+        PROFILER.dump_stats(getProfileName() + '_epoch_' + str(epoch) + '.prof')
+        print "\nPROFILE SAVED TO", getProfileName() + '_epoch_' + str(epoch) + '.prof'
+        PROFILER = None
+
+################# AUDIO SPECTROGRAMS #####################
+#spectrograms are computed from (memory-mapped) wav files, window and filterbank only get computed once per sample rate
+#audio samples have virtual paths: <wav path>@<first spectrogram column>
+SPEC_MATRICES = {}
+def getMelFilterbank(rate):
+
+    #triangular filters, equally spaced on the mel scale, one per image row
+    bins = SPEC_NFFT // 2 + 1
+    fmax = SPEC_FMAX if SPEC_FMAX != None else rate / 2.0
+    mel = np.linspace(2595.0 * np.log10(1.0 + SPEC_FMIN / 700.0), 2595.0 * np.log10(1.0 + fmax / 700.0), IM_SIZE[1] + 2)
+    points = 700.0 * (10 ** (mel / 2595.0) - 1.0)
+    freqs = np.linspace(0, rate / 2.0, bins)
+
+    lower = points[:-2, np.newaxis]
+    center = points[1:-1, np.newaxis]
+    upper = points[2:, np.newaxis]
+    fb = np.maximum(0, np.minimum((freqs - lower) / np.maximum(center - lower, 1e-8), (upper - freqs) / np.maximum(upper - center, 1e-8)))
+
+    return fb.astype('float32')
+
+def getSpecMatrices(rate, flen):
+
+    #window (None = rectangular) and mel filterbank (None = linear)
+    if (rate, flen) not in SPEC_MATRICES:
+        window = np.hanning(flen).astype('float32') if SPEC_WINDOW == 'hann' else None
+        fb = getMelFilterbank(rate) if SPEC_TYPE == 'mel' else None
+        SPEC_MATRICES[(rate, flen)] = (window, fb)
+
+    return SPEC_MATRICES[(rate, flen)]
+
+def getSpecImage(sig, rate):
+
+    #frames with rectangular window
+    flen = int(round(SPEC_WINLEN * rate))
+    hop = int(round(SPEC_WINSTEP * rate))
+    if sig.shape[0] < flen:
+        sig = np.concatenate([sig, np.zeros(flen - sig.shape[0], dtype=sig.dtype)])
+    n = 1 + (sig.shape[0] - flen) // hop
+    frames = np.lib.stride_tricks.as_strided(sig, shape=(n, flen), strides=(sig.strides[0] * hop, sig.strides[0]))
+
+    #all frames at once
+    window, fb = getSpecMatrices(rate, flen)
+    if window is not None:
+        frames = frames * window
+    magspec = np.absolute(np.fft.rfft(frames, SPEC_NFFT))
+
+    #magnitude spectrogram with high frequencies on top
+    if fb is not None:
+        magspec = np.dot(fb, magspec.T)[::-1]
+    else:
 
-            #to gray?
-            if IM_DIM == 1:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-        except:
-            h, w = img.shape
+        #get rid of high frequencies
+        magspec = np.rot90(magspec)[-IM_SIZE[1]:, :]
 
-            #to color?
-            if IM_DIM == 3:
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    #normalize in [0, 1]
+    magspec -= magspec.min(axis=None)
+    magspec /= max(magspec.max(axis=None), 1e-8)
 
-        #resize to conv input size
-        img = cv2.resize(img, (IM_SIZE[0], IM_SIZE[1]))
+    #fix shape to image size without distortion
+    spec = np.zeros((IM_SIZE[1], IM_SIZE[0]), dtype='float32')
+    spec[:magspec.shape[0], :min(IM_SIZE[0], magspec.shape[1])] = magspec[:, :IM_SIZE[0]]
+
+    #to color?
+    if IM_DIM == 3:
+        spec = cv2.cvtColor(spec, cv2.COLOR_GRAY2BGR)
+
+    return spec
+
+def getAudioWindow(sig, rate, column):
+
+    #mono float signal of one IM_SIZE window starting at spectrogram column
+    hop = int(round(SPEC_WINSTEP * rate))
+    wlen = (IM_SIZE[0] - 1) * hop + int(round(SPEC_WINLEN * rate))
+    chunk = np.asarray(sig[column * hop:column * hop + wlen], dtype='float32')
+    if chunk.ndim > 1:
+        chunk = chunk.mean(axis=1)
+
+    return chunk
+
+def getAudioChunkCount(index, folder, name):
+
+    #number of IM_SIZE chunks per wav file is kept in the dataset index as long as file and spec params do not change
+    path = os.path.join(folder, name)
+    key = [list(index[folder]['files'][name]), IM_SIZE[0], SPEC_WINSTEP, SPEC_WINLEN]
+    entry = index.setdefault('audio', {}).get(path)
+    if entry != None and entry[0] == key:
+        return entry[1], False
+
+    rate, sig = wavfile.read(path, mmap=True)
+    hop = int(round(SPEC_WINSTEP * rate))
+    columns = 1 + max(0, sig.shape[0] - int(round(SPEC_WINLEN * rate))) // hop
+    index['audio'][path] = (key, max(1, columns // IM_SIZE[0]))
+
+    return index['audio'][path][1], True
+
+def isAudioSample(path):
+
+    return path.rsplit('@', 1)[0].lower().endswith('.wav')
+
+def decodeAudioChunk(path):
+
+    #float32 spectrogram, no 8-bit images involved
+    start = time.time()
+    path, column = path.rsplit('@', 1)
+    rate, sig = wavfile.read(path, mmap=True)
+    spec = getSpecImage(getAudioWindow(sig, rate, int(column)), rate)
+    addTiming('spectrogram', start)
+
+    return spec
+
+#################### IMAGE CACHE ########################
+#decoded images are cached as uint8 (4x smaller than float32) in a LRU cache with a byte budget
+#noise samples get their own pinned area which never gets evicted
+CACHE = OrderedDict()
+CACHE_PINNED = {}
+CACHE_STATS = {'hits':0, 'misses':0, 'evictions':0, 'bytes':0, 'pinned_bytes':0}
+EPOCH_CACHE_STATS = {}
+def getCacheBudget(size):
+
+    #every worker process has its own cache, so we have to split the budget
+    return size * 1024 * 1024 // max(1, NUM_WORKERS)
+
+def cacheGet(path):
+
+    #pinned samples first
+    if path in CACHE_PINNED:
+        CACHE_STATS['hits'] += 1
+        return CACHE_PINNED[path]
+
+    #re-insert cached image to mark it as most recently used
+    img = CACHE.pop(path, None)
+    if img is None:
+        CACHE_STATS['misses'] += 1
+    else:
+        CACHE[path] = img
+        CACHE_STATS['hits'] += 1
+
+    return img
+
+def cachePut(path, img, pinned=False):
+
+    #pinned area is filled until the budget is reached and never evicted
+    if pinned:
+        if CACHE_STATS['pinned_bytes'] + img.nbytes <= getCacheBudget(NOISE_CACHE_SIZE):
+            CACHE_PINNED[path] = img
+            CACHE_STATS['pinned_bytes'] += img.nbytes
+        return
+
+    budget = getCacheBudget(CACHE_SIZE)
+    if img.nbytes > budget:
+        return
+
+    #evict least recently used images until the new one fits
+    while CACHE_STATS['bytes'] + img.nbytes > budget:
+        _, old = CACHE.popitem(last=False)
+        CACHE_STATS['bytes'] -= old.nbytes
+        CACHE_STATS['evictions'] += 1
+
+    CACHE[path] = img
+    CACHE_STATS['bytes'] += img.nbytes
+
+def popCacheStats():
+
+    #counters since last call (the sizes are reported as they are)
+    stats = dict(CACHE_STATS)
+    stats['pid'] = os.getpid()
+    CACHE_STATS['hits'] = 0
+    CACHE_STATS['misses'] = 0
+    CACHE_STATS['evictions'] = 0
+
+    return stats
+
+def addCacheStats(stats):
+
+    global EPOCH_CACHE_STATS
+
+    #sum up counters of all processes, sizes are tracked per process
+    for k in ['hits', 'misses', 'evictions']:
+        EPOCH_CACHE_STATS[k] = EPOCH_CACHE_STATS.get(k, 0) + stats[k]
+    EPOCH_CACHE_STATS.setdefault('sizes', {})[stats['pid']] = (stats['bytes'], stats['pinned_bytes'])
+
+def showCacheStats():
+
+    global EPOCH_CACHE_STATS
+
+    if len(EPOCH_CACHE_STATS) == 0:
+        return
+
+    lookups = max(1, EPOCH_CACHE_STATS['hits'] + EPOCH_CACHE_STATS['misses'])
+    size = sum([b[0] for b in EPOCH_CACHE_STATS['sizes'].values()]) // (1024 * 1024)
+    pinned = sum([b[1] for b in EPOCH_CACHE_STATS['sizes'].values()]) // (1024 * 1024)
+    print "CACHE HITS:", EPOCH_CACHE_STATS['hits'],
+    print "MISSES:", EPOCH_CACHE_STATS['misses'],
+    print "HIT RATE:", (int(EPOCH_CACHE_STATS['hits'] * 1000 / lookups) / 10.0), "%",
+    print "EVICTIONS:", EPOCH_CACHE_STATS['evictions'],
+    print "SIZE:", size, "MB",
+    print "PINNED:", pinned, "MB"
+
+    EPOCH_CACHE_STATS = {}
+
+def decodeImage(path):
+
+    #audio samples are computed from the wav file
+    if isAudioSample(path):
+        return decodeAudioChunk(path)
+
+    #open image (reading the file and decoding are timed separately)
+    start = time.time()
+    data = np.fromfile(path, dtype='uint8')
+    addTiming('read', start)
+    start = time.time()
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    #DEBUG
+    try:
+        h, w = img.shape[:2]
+    except:
+        print "IMAGE NONE-TYPE:", path
 
-        #convert to floats between 0 and 1
-        img = np.asarray(img / 255., dtype='float32')  
+    #original image dimensions
+    try:
+        h, w, d = img.shape
+
+        #to gray?
+        if IM_DIM == 1:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
-        if useCache:
-            CACHE[path] = img
-        return img
+    except:
+        h, w = img.shape
+
+        #to color?
+        if IM_DIM == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+    #resize to conv input size
+    img = cv2.resize(img, (IM_SIZE[0], IM_SIZE[1]))
+    addTiming('decode', start)
+
+    return img
+
+#################### DATASET SHARDS #####################
+#all images are decoded and resized once and stored as uint8 in one memory-mapped .npy file per shard
+#the page cache shares these files between all worker processes
+SHARDS = {}
+def getShardPaths(name):
+
+    return os.path.join(SHARD_PATH, name + '.npy'), os.path.join(SHARD_PATH, name + '_index.pkl')
+
+def loadShardIndex(name):
+
+    _, index_path = getShardPaths(name)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'rb') as f:
+        index = pickle.load(f)
+
+    #shards packed with other image settings are useless
+    if index['im_size'] != IM_SIZE or index['im_dim'] != IM_DIM:
+        return None
+
+    return index
+
+def loadShard(name):
+
+    #every process opens the memory map on first access
+    if name not in SHARDS:
+        data_path, _ = getShardPaths(name)
+        index = loadShardIndex(name)
+        if index != None and os.path.exists(data_path):
+            SHARDS[name] = (np.load(data_path, mmap_mode='r'), index['rows'])
+        else:
+            SHARDS[name] = (None, {})
+
+    return SHARDS[name]
+
+def getShardImage(path):
+
+    #returns a zero-copy view into the memory map (or None if the image is not packed)
+    for name in ['images', 'noise']:
+        data, rows = loadShard(name)
+        if path in rows:
+            return data[rows[path]]
+
+    return None
+
+def decodeShardImage(path):
+
+    #broken images are left out of the shard
+    try:
+        return decodeImage(path)
+    except:
+        return None
+
+def packShard(name, paths):
+
+    #each image is packed only once, even if class balancing duplicated it
+    paths = sorted(set(paths))
+
+    #shard is still up to date? (broken images count as packed, they would fail again)
+    index = loadShardIndex(name)
+    if index != None and set(paths).issubset(set(index['rows']) | set(index.get('broken', []))):
+        return
+
+    print "PACKING", len(paths), name.upper(), "INTO SHARD...",
+    start = time.time()
+    data_path, index_path = getShardPaths(name)
+    if not os.path.exists(SHARD_PATH):
+        os.makedirs(SHARD_PATH)
+
+    #contiguous uint8 array with one row per image
+    shape = (len(paths), IM_SIZE[1], IM_SIZE[0]) + ((IM_DIM,) if IM_DIM == 3 else ())
+    data = np.lib.format.open_memmap(data_path, mode='w+', dtype='uint8', shape=shape)
+
+    #decode in worker processes, rows are written in order
+    pool = getWorkerPool()
+    if pool == None:
+        images = itertools.imap(decodeShardImage, paths)
+    else:
+        images = pool.imap(decodeShardImage, paths, chunksize=32)
+
+    rows = {}
+    broken = []
+    labels = []
+    for i, img in enumerate(images):
+        labels.append(paths[i].split("/")[-2])
+        if img is not None:
+            data[i] = img
+            rows[paths[i]] = i
+        else:
+            broken.append(paths[i])
+    data.flush()
+    del data
+
+    #label index with row numbers for every path
+    with open(index_path, 'wb') as f:
+        pickle.dump({'rows':rows, 'broken':broken, 'labels':labels, 'im_size':IM_SIZE, 'im_dim':IM_DIM}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    #re-open on next access
+    SHARDS.pop(name, None)
+
+    print "DONE! (", int(time.time() - start), "s )"
+
+def packDataset():
+
+    #one-time pack step for dataset and noise samples
+    packShard('images', [path for path, _ in TRAIN + VAL])
+    packShard('noise', NOISE)
+
+def openImage(path, useCache=USE_CACHE, pinned=False):
+
+    #packed images come straight from the memory map
+    img = None
+    if USE_SHARD:
+        img = getShardImage(path)
+
+    #using a cache saves some time after first epoch
+    if img is None and (useCache or pinned):
+        img = cacheGet(path)
+        if img is None:
+
+            #decoded uint8 pixels are what we cache
+            img = decodeImage(path)
+            cachePut(path, img, pinned)
+
+    if img is None:
+        img = decodeImage(path)
+
+    #convert to floats between 0 and 1 (spectrograms of audio samples already are)
+    if img.dtype == np.uint8:
+        img = np.asarray(img / 255., dtype='float32')
+
+    return img
 
 def imageAugmentation(img):
 
@@ -229,7 +901,7 @@ def imageAugmentation(img):
 
     #add noise samples
     if 'noise_samples' in AUG and RANDOM.choice([True, False], p=[AUG['noise_samples'][0], 1 - AUG['noise_samples'][0]]):
-        img += openImage(NOISE[RANDOM.choice(range(0, len(NOISE)))], True) * AUG['noise_samples'][1]
+        img += openImage(NOISE[RANDOM.choice(range(0, len(NOISE)))], pinned=True) * AUG['noise_samples'][1]
         img -= img.min(axis=None)
         img /= img.max(axis=None)
 
@@ -243,8 +915,123 @@ def imageAugmentation(img):
     #cv2.waitKey(-1)
 
     return img
+
+AUG_TYPES = ['crop', 'flip', 'roll', 'mean', 'noise', 'noise_samples', 'brightness']
+NOISE_BANK = {}
+def getNoiseBank(size):
+
+    #gaussian noise fields are cut from a bank of standard normal values at random offsets
+    #drawing fresh values for every image is the most expensive part of the augmentation
+    if size not in NOISE_BANK:
+        NOISE_BANK[size] = np.random.RandomState(RANDOM_SEED).standard_normal(size * 8).astype('float32')
+
+    return NOISE_BANK[size]
+
+def toChannelsFirst(img):
+
+    #(h, w) or (h, w, d) image to (d, h, w)
+    if img.ndim == 3:
+        return np.transpose(img, (2, 0, 1))
+    else:
+        return img[np.newaxis]
+
+def imageBatchAugmentation(x):
+
+    AUG = IM_AUGMENTATION
+    b, d, h, w = x.shape
+
+    #we draw all masks and parameters at once: one bernoulli column per type and five parameter columns
+    r = RANDOM.random_sample((b, len(AUG_TYPES) + 5))
+    p = np.array([AUG[t][0] if t in AUG else 0.0 for t in AUG_TYPES])
+    m = r[:, :len(AUG_TYPES)] < p
+    r = r[:, len(AUG_TYPES):]
+
+    #Random Crop (without padding) has to be resized image by image
+    for i in np.where(m[:, 0])[0]:
+        cropw = RANDOM.randint(1, int(float(w) * AUG['crop'][1]))
+        croph = RANDOM.randint(1, int(float(h) * AUG['crop'][1]))
+        img = np.transpose(x[i], (1, 2, 0))[croph:-croph, cropw:-cropw]
+        x[i] = toChannelsFirst(cv2.resize(img, (IM_SIZE[0], IM_SIZE[1])))
+
+    #Flip - 1 = Horizontal, 0 = Vertical
+    idx = np.where(m[:, 1])[0]
+    if idx.shape[0] > 0:
+        if AUG['flip'][1] >= 0:
+            x[idx] = x[idx][:, :, :, ::-1] if AUG['flip'][1] == 1 else x[idx][:, :, ::-1, :]
+        else:
+            x[idx] = x[idx][:, :, ::-1, ::-1]
+
+    #Wrap shift (roll up/down and left/right)
+    #two contiguous slice copies per image are faster than a batch-wide index gather
+    idx = np.where(m[:, 2])[0]
+    if idx.shape[0] > 0:
+        sh = (h * (r[idx, 0] * 2 - 1) * AUG['roll'][1][1]).astype('int32')
+        sw = (w * (r[idx, 1] * 2 - 1) * AUG['roll'][1][0]).astype('int32')
+        for i in xrange(idx.shape[0]):
+            x[idx[i]] = np.roll(x[idx[i]], (sh[i], sw[i]), axis=(1, 2))
+
+    #substract/add mean
+    idx = np.where(m[:, 3])[0]
+    if idx.shape[0] > 0:
+        x[idx] += np.mean(x[idx], axis=(1, 2, 3), keepdims=True) * AUG['mean'][1]
+
+    #gaussian noise
+    idx = np.where(m[:, 4])[0]
+    if idx.shape[0] > 0:
+        bank = getNoiseBank(d * h * w)
+        std = (r[idx, 2] * AUG['noise'][1]**0.5).astype('float32')
+        offsets = RANDOM.randint(0, bank.shape[0] - d * h * w, idx.shape[0])
+        noise = np.stack([bank[o:o + d * h * w] for o in offsets]).reshape(-1, d, h, w)
+        x[idx] = np.clip(x[idx] + noise * std[:, None, None, None], 0.0, 1.0)
+
+    #add noise samples
+    idx = np.where(m[:, 5])[0]
+    if idx.shape[0] > 0:
+        n = (r[idx, 3] * len(NOISE)).astype('int32')
+        noise = np.stack([toChannelsFirst(openImage(NOISE[i], pinned=True)) for i in n])
+        x_n = x[idx] + noise * AUG['noise_samples'][1]
+        x_n -= x_n.min(axis=(1, 2, 3), keepdims=True)
+        x_n /= np.maximum(x_n.max(axis=(1, 2, 3), keepdims=True), 1e-8)
+        x[idx] = x_n
+
+    #adjust brightness
+    idx = np.where(m[:, 6])[0]
+    if idx.shape[0] > 0:
+        f = AUG['brightness'][1][0] + r[idx, 4] * (AUG['brightness'][1][1] - AUG['brightness'][1][0])
+        x[idx] = np.clip(x[idx] * f[:, None, None, None].astype('float32'), 0.0, 1.0)
+
+    return x
+
+def benchmarkAugmentation(num_batches=5):
+
+    #we compare both augmentation paths on the same batch of images
+    x = np.concatenate([loadImageAndTarget(sample, False)[0] for sample in TRAIN[:BATCH_SIZE]])
+
+    #per image
+    start = time.time()
+    for i in xrange(num_batches):
+        for j in xrange(x.shape[0]):
+            imageAugmentation(np.transpose(x[j], (1, 2, 0)).copy() if IM_DIM == 3 else x[j, 0].copy())
+    image_rate = x.shape[0] * num_batches / (time.time() - start)
+
+    #whole batch
+    x_b = np.zeros_like(x)
+    start = time.time()
+    for i in xrange(num_batches):
+        x_b[:] = x
+        imageBatchAugmentation(x_b)
+    batch_rate = x.shape[0] * num_batches / (time.time() - start)
+
+    print "AUGMENTATION THROUGHPUT PER IMAGE:", int(image_rate), "images/s",
+    print "PER BATCH:", int(batch_rate), "images/s",
+    print "(", (int(batch_rate / image_rate * 10) / 10.0), "x )"
+
+    return image_rate, batch_rate
     
-def loadImageAndTarget(path, doAugmentation=True):
+def loadImageAndTarget(sample, doAugmentation=True):
+
+    #dataset samples are (path, class index) tuples
+    path, index = sample
 
     #here we open the image
     img = openImage(path)
@@ -253,12 +1040,6 @@ def loadImageAndTarget(path, doAugmentation=True):
     if IM_AUGMENTATION != None and doAugmentation:
         img = imageAugmentation(img)
     
-    #we want to use subfolders as class labels
-    label = path.split("/")[-2]
-
-    #we need to get the index of our label from CLASSES
-    index = CLASSES.index(label)
-
     #allocate array for target
     target = np.zeros((NUM_CLASSES), dtype='float32')
 
@@ -281,69 +1062,315 @@ def getSameClassAugmentation(x, y):
 
     #are there some samples with the same class label?
     scl = np.where(np.sum(y, axis=0) > 1)[0]
-    acnt = 0
-    while scl.shape[0] > 0 and acnt < MAX_SAME_CLASS_COMBINATIONS:
-
-        #randomly chosen class
-        c = RANDOM.choice(scl)
-
-        #get all samples of this selected class
-        s = []
-        for i in range(0, y.shape[0]):
-            if y[i][c] == 1:
-              s.append(i)
+    if scl.shape[0] == 0:
+        return x, y
 
-        #combine first two samples
-        x[s[0]] += x[s[1]]
+    #randomly chosen classes
+    c = RANDOM.permutation(scl)[:MAX_SAME_CLASS_COMBINATIONS]
 
-        #re-normalize new image
-        x[s[0]] -= x[s[0]].min(axis=None)
-        x[s[0]] /= x[s[0]].max(axis=None)
+    #get first two samples of each selected class (one lookup for all classes)
+    s = np.argsort(y[:, c].T != 1, axis=1, kind='mergesort')[:, :2]
 
-        #remove augmented class
-        scl = np.delete(scl, np.where(scl == c))
-        acnt += 1
+    #combine first two samples
+    x_s = x[s[:, 0]] + x[s[:, 1]]
 
-        #show
-        #print scl, acnt, c
-        #cv2.imshow("BA", x[s[0]].reshape(IM_SIZE[1], IM_SIZE[0], IM_DIM))
-        #cv2.waitKey(-1)
+    #re-normalize new images
+    x_s -= x_s.min(axis=(1, 2, 3), keepdims=True)
+    x_s /= np.maximum(x_s.max(axis=(1, 2, 3), keepdims=True), 1e-8)
+    x[s[:, 0]] = x_s
 
     return x, y        
 
 def getAugmentedBatches(x, y):
 
+    #we need at least two images to combine
+    n = x.shape[0]
+    if n < 2:
+        return x, y
+
     #augment batch until desired number of target labels per image is reached
-    while np.mean(np.sum(y, axis=1)) < MEAN_TARGETS_PER_IMAGE:
+    #every round combines all missing pairs at once and the number of rounds is limited
+    for r in xrange(MAX_MIXING_ROUNDS):
 
-        #get two images to combine (we try to prevent i == j (which could result in infinite loops) with excluding ranges)
-        i = RANDOM.choice(range(1, x.shape[0] - 1))
-        j = RANDOM.choice(range(0, i) + range(i + 1, x.shape[0]))
+        #how many target labels are still missing?
+        missing = int(np.ceil(n * MEAN_TARGETS_PER_IMAGE - np.sum(y)))
+        if missing <= 0:
+            break
 
-        #add images
-        x[i] += x[j]
+        #get pairs of images to combine: distinct images i and a partner j != i for each of them
+        i = RANDOM.permutation(n)[:min(missing, n)]
+        j = (i + RANDOM.randint(1, n, i.shape[0])) % n
 
-        #re-normalize new image
-        x[i] -= x[i].min(axis=None)
-        x[i] /= x[i].max(axis=None)
+        #add images (partners are copied before we change anything)
+        x_i = x[i] + x[j]
 
-        #combine targets (makes this task a multi-label classification!)
-        y[i] = np.logical_or(y[i], y[j])
+        #re-normalize new images
+        x_i -= x_i.min(axis=(1, 2, 3), keepdims=True)
+        x_i /= np.maximum(x_i.max(axis=(1, 2, 3), keepdims=True), 1e-8)
+        x[i] = x_i
 
-        #TODO: We still might end up in an infinite loop
-        #and should add a break in case something is fishy
+        #combine targets (makes this task a multi-label classification!)
+        y[i] = np.maximum(y[i], y[j])
 
-        #show
-        #cv2.imshow("BA", x[i].reshape(IM_SIZE[1], IM_SIZE[0], IM_DIM))
-        #cv2.waitKey(-1)
-    
     return x, y
 
+#################### BATCH GENERATOR #####################
+WORKER_POOL = None
+def initWorker():
+
+    #workers should ignore ctrl+c, the main process handles interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    #opencv threads do not play well with forked processes
+    cv2.setNumThreads(0)
+
+def getWorkerPool():
+
+    global WORKER_POOL
+
+    #we fork the worker processes only once and re-use them every epoch
+    if WORKER_POOL == None and NUM_WORKERS > 0:
+
+        #workers need to inherit the batch buffers
+        getBatchRing()
+        WORKER_POOL = multiprocessing.Pool(NUM_WORKERS, initWorker)
+
+    return WORKER_POOL
+
+#batches are assembled in a ring of preallocated shared memory slots, batch i goes into slot i % ring size
+#a slot is only re-used after the consumer moved on (prefetched batches + consumed batch + spare slots)
+BATCH_RING = []
+def getBatchRing():
+
+    if len(BATCH_RING) == 0:
+        for i in xrange(PREFETCH_BATCHES + 3):
+            x = multiprocessing.RawArray('f', BATCH_SIZE * IM_DIM * IM_SIZE[1] * IM_SIZE[0])
+            y = multiprocessing.RawArray('f', BATCH_SIZE * NUM_CLASSES)
+            BATCH_RING.append((np.frombuffer(x, dtype='float32').reshape(BATCH_SIZE, IM_DIM, IM_SIZE[1], IM_SIZE[0]),
+                               np.frombuffer(y, dtype='float32').reshape(BATCH_SIZE, NUM_CLASSES)))
+
+    return BATCH_RING
+
+def getRingPrefetch():
+
+    #the ring is allocated once, so PREFETCH_BATCHES might have changed since
+    return len(getBatchRing()) - 3
+
+def getDatasetChunk(split):
+
+    #get batch-sized chunks of image paths
+    for i in xrange(0, len(split), BATCH_SIZE):
+        yield split[i:i + BATCH_SIZE]
+
+def loadBatch(task):
+
+    chunk, doAugmentation, batchAugmentation, seed, slot = task
+    bstart = time.time()
+
+    #whole batches get augmented at once?
+    vectorized = doAugmentation and VECTORIZED_AUGMENTATION and IM_AUGMENTATION != None
+
+    #every batch has its own seed, this way results do not depend on which worker loads which batch
+    RANDOM.seed(seed)
+
+    #we write image data and targets directly into our ring slot
+    x_s, y_s = getBatchRing()[slot]
+    y_s[:len(chunk)] = 0.0
+
+    ib = 0
+    for path, index in chunk:
+
+        try:
+
+            #load image data
+            img = openImage(path)
+            if doAugmentation and not vectorized and IM_AUGMENTATION != None:
+                start = time.time()
+                img = imageAugmentation(img)
+                addTiming('augmentation', start)
+            x_s[ib] = toChannelsFirst(img)
+
+            #one-hot target, the class index is part of the sample
+            y_s[ib, index] = 1.0
+            ib += 1
+
+        except:
+            print "ERROR LOADING IMAGE:", path
+            continue
+
+    #trim to actual size
+    x_b = x_s[:ib]
+    y_b = y_s[:ib]
+
+    #batch-wide image augmentation?
+    if vectorized:
+        start = time.time()
+        x_b = imageBatchAugmentation(x_b)
+        addTiming('augmentation', start, ib)
+
+    #same class augmentation?
+    start = time.time()
+    if doAugmentation and SAME_CLASS_AUGMENTATION and x_b.shape[0] > 2:
+        x_b, y_b = getSameClassAugmentation(x_b, y_b)
+
+    #batch augmentation?
+    if batchAugmentation and x_b.shape[0] >= BATCH_SIZE // 2:
+        x_b, y_b = getAugmentedBatches(x_b, y_b)
+    addTiming('mixing', start)
+
+    #augmentations should work in place, but we make sure the slot holds the result
+    if not np.may_share_memory(x_b, x_s):
+        x_s[:ib] = x_b
+    if not np.may_share_memory(y_b, y_s):
+        y_s[:ib] = y_b
+
+    addTiming('batch', bstart, ib)
+
+    return slot, ib, popCacheStats(), popTimings()
+
+def getNextImageBatch(split=None, doAugmentation=True, batchAugmentation=MULTI_LABEL):
+
+    #no split? all train samples (training passes the balanced samples of the epoch)
+    if split == None:
+        split = TRAIN
+
+    #base seed for this pass over the split (drawn in the main process to keep runs reproducible)
+    seed = RANDOM.randint(0, 2**31 - 1)
+
+    #one task per batch
+    ring = len(getBatchRing())
+    tasks = [(chunk, doAugmentation, batchAugmentation, [RANDOM_SEED, seed, i], i % ring) for i, chunk in enumerate(getDatasetChunk(split))]
+
+    #batches are views into the batch ring and only valid until we ask for the next batch
+    #(the worker pool prefetches, without workers we load batches in a background thread)
+    if getWorkerPool() == None:
+        return threadedBatchGenerator(batchGenerator(tasks), num_cached=getRingPrefetch())
+    else:
+        return batchGenerator(tasks)
+
+def batchGenerator(tasks):
+
+    pool = getWorkerPool()
+    ring = getBatchRing()
+
+    #no workers? we load all batches in the main process
+    if pool == None:
+        for task in tasks:
+
+            #seeding a batch must not change the random state of the main process
+            state = RANDOM.get_state()
+            slot, n, stats, timings = loadBatch(task)
+            RANDOM.set_state(state)
+
+            addCacheStats(stats)
+            addTimings(timings)
+            yield ring[slot][0][:n], ring[slot][1][:n]
+
+    else:
+
+        #we keep a bounded number of batches in flight, results are yielded in order
+        tasks = iter(tasks)
+        pending = deque()
+        for task in itertools.islice(tasks, getRingPrefetch()):
+            pending.append(pool.apply_async(loadBatch, (task,)))
+
+        while len(pending) > 0:
+
+            #number of batches which are ready when we need one (0 means we are waiting for the workers)
+            addCounter('queue_depth', sum([r.ready() for r in pending]))
+
+            slot, n, stats, timings = pending.popleft().get()
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(loadBatch, (task,)))
+
+            addCacheStats(stats)
+            addTimings(timings)
+            yield ring[slot][0][:n], ring[slot][1][:n]
+
+def boundedImap(pool, func, items, prefetch):
+
+    #like pool.imap, but only a bounded number of results wait in the main process
+    if pool == None:
+        for result in itertools.imap(func, items):
+            yield result
+    else:
+        items = iter(items)
+        pending = deque([pool.apply_async(func, (item,)) for item in itertools.islice(items, prefetch)])
+        try:
+            while len(pending) > 0:
+                result = pending.popleft().get()
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.apply_async(func, (item,)))
+                yield result
+        finally:
+
+            #closed early? a worker that is still sending a large result would block pool.terminate()
+            for r in pending:
+                r.wait()
+
+def benchmarkBatchAssembly(num_batches=5):
+
+    #per-batch assembly time: allocated and concatenated samples vs. writing into a ring slot
+    chunk = TRAIN[:BATCH_SIZE]
+
+    start = time.time()
+    for i in xrange(num_batches):
+        samples = [loadImageAndTarget(sample, False) for sample in chunk]
+        np.concatenate([x for x, _ in samples])
+        np.concatenate([y for _, y in samples])
+    alloc_time = (time.time() - start) / num_batches
+
+    state = RANDOM.get_state()
+    start = time.time()
+    for i in xrange(num_batches):
+        loadBatch((chunk, False, False, [RANDOM_SEED, i], i % len(getBatchRing())))
+    ring_time = (time.time() - start) / num_batches
+    RANDOM.set_state(state)
+
+    print "BATCH ASSEMBLY ALLOCATED:", int(alloc_time * 1000), "ms",
+    print "RING SLOT:", int(ring_time * 1000), "ms"
+
+    return alloc_time, ring_time
+
+#Loading batches in a background thread during forward/backward passes saves a lot of time
+#Credit: J. Schlueter (https://github.com/Lasagne/Lasagne/issues/12)
+#Note: num_cached must stay below the batch ring size (see getRingPrefetch)
+def threadedBatchGenerator(generator, num_cached=10):
+
+    queue = Queue.Queue(maxsize=num_cached)
+    sentinel = object()
+
+    #define producer (putting items into queue)
+    def producer():
+        for item in generator:
+            queue.put(item)
+        queue.put(sentinel)
+
+    #start producer (in a background thread)
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    #run as consumer (read items from queue, in current thread)
+    addCounter('queue_depth', queue.qsize())
+    item = queue.get()
+    while item is not sentinel:
+        yield item
+        queue.task_done()
+        addCounter('queue_depth', queue.qsize())
+        item = queue.get()
+
 ################## BUILDING THE MODEL ###################
-def buildModel(mtype=1):
+def buildModel(mtype=1, num_classes=None, multi_label=None):
 
     print "BUILDING MODEL TYPE", mtype, "..."
 
+    #ensemble members have their own class subsets
+    if num_classes == None:
+        num_classes = NUM_CLASSES
+    if multi_label == None:
+        multi_label = MULTI_LABEL
+
     #default settings (Model 1)
     filters = 64
     first_stride = 2
@@ -388,10 +1415,10 @@ def buildModel(mtype=1):
     net = l.DropoutLayer(net, DROPOUT)  
 
     #Classification Layer
-    if MULTI_LABEL:
-        net = l.DenseLayer(net, NUM_CLASSES, nonlinearity=nonlinearities.sigmoid, W=init.HeNormal(gain=1))
+    if multi_label:
+        net = l.DenseLayer(net, num_classes, nonlinearity=nonlinearities.sigmoid, W=init.HeNormal(gain=1))
     else:
-        net = l.DenseLayer(net, NUM_CLASSES, nonlinearity=nonlinearities.softmax, W=init.HeNormal(gain=1))
+        net = l.DenseLayer(net, num_classes, nonlinearity=nonlinearities.softmax, W=init.HeNormal(gain=1))
 
     print "...DONE!"
 
@@ -401,37 +1428,171 @@ def buildModel(mtype=1):
 
     return net
 
-NET = buildModel(MODEL_TYPE)
+#model is built on first use
+NET = None
+def getNet():
+
+    global NET
+
+    if NET == None:
+
+        #we need the number of classes for the output layer
+        loadDataset()
+        NET = buildModel(MODEL_TYPE)
+
+        #load pretrained params?
+        if PRETRAINED_MODEL != None:
+            loadParams(-1, PRETRAINED_MODEL)
+
+    return NET
+
 ##################  MODEL SAVE/LOAD  ####################
-BEST_PARAMS = None
+#checkpoints are a json header (config, names, shapes, dtypes and offsets of all arrays) followed by the raw array data
+#this way we can memory-map them and we store the optimizer state to resume training exactly
+CHECKPOINT_MAGIC = 'BIRDCKPT'
 BEST_EPOCH = 0
-def saveParams(epoch, params=None):    
+SAVE_THREAD = None
+def getCheckpointName(epoch):
+
+    return MODEL_PATH + "birdCLEF_" + RUN_NAME + "_model_params_epoch_" + str(epoch) + ".ckpt"
+
+def getBestCheckpointName():
+
+    return MODEL_PATH + "birdCLEF_" + RUN_NAME + "_model_params_best.ckpt"
+
+def getFinetunedCheckpointName(epoch):
+
+    #fine-tuned heads must not replace training snapshots
+    return MODEL_PATH + "birdCLEF_" + RUN_NAME + "_model_params_finetuned_epoch_" + str(epoch) + ".ckpt"
+
+def writeCheckpoint(filename, header, arrays):
+
+    #data of every array starts 64 byte aligned
+    entries = []
+    offset = 0
+    for name, a in arrays:
+        entries.append({'name':name, 'shape':list(a.shape), 'dtype':a.dtype.str, 'offset':offset})
+        offset += (a.nbytes + 63) // 64 * 64
+    header['arrays'] = entries
+
+    #pad header so that the data starts 64 byte aligned, too
+    h = json.dumps(header)
+    h += ' ' * (-(len(CHECKPOINT_MAGIC) + 8 + len(h)) % 64)
+
+    #we write to a temp file first, a killed process should not leave a broken checkpoint
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        f.write(struct.pack('<Q', len(h)))
+        f.write(h)
+        for name, a in arrays:
+            data = np.ascontiguousarray(a).tostring()
+            f.write(data)
+            f.write('\0' * (-len(data) % 64))
+    os.rename(filename + '.tmp', filename)
+
+def readCheckpoint(filename):
+
+    with open(filename, 'rb') as f:
+        if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+            raise ValueError('Not a checkpoint: ' + filename)
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size))
+
+    #all arrays are zero-copy views into the memory-mapped file
+    raw = np.memmap(filename, dtype='uint8', mode='r', offset=len(CHECKPOINT_MAGIC) + 8 + size)
+    arrays = {}
+    for e in header['arrays']:
+        dtype = np.dtype(str(e['dtype']))
+        nbytes = int(np.prod(e['shape'])) * dtype.itemsize
+        arrays[e['name']] = raw[e['offset']:e['offset'] + nbytes].view(dtype).reshape(e['shape'])
+
+    return header, arrays
+
+def waitForSnapshots():
+
+    #there is at most one pending snapshot, so we never hold more than one extra copy of the params
+    if SAVE_THREAD != None:
+        SAVE_THREAD.join()
+
+def saveParams(epoch, params=None, filename=None):
+
+    global SAVE_THREAD
+
     print "EXPORTING MODEL PARAMS...",
+
+    #snapshot (copy) of all arrays, training can go on while we write them
+    arrays = []
     if params == None:
-        params = l.get_all_param_values(NET)
-    net_filename = MODEL_PATH + "birdCLEF_" + RUN_NAME + "_model_params_epoch_" + str(epoch) + ".pkl"
+        params = l.get_all_param_values(getNet())
+
+        #optimizer state only matches the current params
+        arrays += [('optimizer_' + str(i), v.get_value()) for i, v in enumerate(OPTIMIZER_STATE)]
+
+        #random state and epoch to resume training exactly
+        state = RANDOM.get_state()
+        arrays.append(('random_keys', state[1]))
+    else:
+        state = None
+    arrays = [('param_' + str(i), p) for i, p in enumerate(params)] + arrays
+
+    #config we need to rebuild the model
+    header = {'epoch':epoch,
+              'run_name':RUN_NAME,
+              'model_type':MODEL_TYPE,
+              'im_size':list(IM_SIZE),
+              'im_dim':IM_DIM,
+              'multi_label':MULTI_LABEL,
+              'optimizer':OPTIMIZER,
+              'classes':CLASSES,
+              'num_params':len(params),
+              'num_optimizer_state':len(arrays) - len(params) - (1 if state != None else 0),
+              'random_state':list(state[2:]) if state != None else None}
+
+    if filename == None:
+        filename = getCheckpointName(epoch)
     if not os.path.exists(MODEL_PATH):
         os.makedirs(MODEL_PATH)
-    with open(net_filename, 'w') as f:
-        pickle.dump(params, f) 
-    print "DONE!"
+
+    #write in background?
+    waitForSnapshots()
+    if ASYNC_SNAPSHOTS:
+        SAVE_THREAD = threading.Thread(target=writeCheckpoint, args=(filename, header, arrays))
+        SAVE_THREAD.start()
+        print "STARTED!"
+    else:
+        writeCheckpoint(filename, header, arrays)
+        print "DONE!"
 
 def loadParams(epoch, filename=None):
+
+    global PENDING_OPTIMIZER_STATE
+
     print "IMPORTING MODEL PARAMS...",
     if filename == None:
-        net_filename = MODEL_PATH + "birdCLEF_" + RUN_NAME + "_model_params_epoch_" + str(epoch) + ".pkl"
+        net_filename = getCheckpointName(epoch)
     else:
         net_filename = MODEL_PATH + filename
-    with open(net_filename, 'rb') as f:
-        params = pickle.load(f)
+
+    #old pickled param lists
+    if net_filename.endswith('.pkl'):
+        with open(net_filename, 'rb') as f:
+            params = pickle.load(f)
+    else:
+        header, arrays = readCheckpoint(net_filename)
+        params = [arrays['param_' + str(i)] for i in xrange(header['num_params'])]
+
+        #resume training? we restore optimizer state as soon as the updates exist
+        if LOAD_OUTPUT_LAYER and EPOCH_START > 1:
+            PENDING_OPTIMIZER_STATE = [arrays['optimizer_' + str(i)] for i in xrange(header['num_optimizer_state'])]
+            if header['random_state'] != None:
+                RANDOM.set_state(tuple(['MT19937', np.array(arrays['random_keys'])] + header['random_state']))
+
     if LOAD_OUTPUT_LAYER:
-        l.set_all_param_values(NET, params)
+        l.set_all_param_values(getNet(), params)
     else:
-        l.set_all_param_values(l.get_all_layers(NET)[:-1], params[:-2])
+        l.set_all_param_values(l.get_all_layers(getNet())[:-1], params[:-2])
     print "DONE!"
 
-if PRETRAINED_MODEL != None:
-    loadParams(-1, PRETRAINED_MODEL)
 #################### LOSS FUNCTION ######################
 def calc_loss(prediction, targets):
 
@@ -450,21 +1611,6 @@ def calc_loss_multi(prediction, targets):
     
     return loss
 
-#theano variable for the class targets
-targets = T.matrix('targets', dtype=theano.config.floatX)
-
-#get the network output
-prediction = l.get_output(NET)
-
-#we use L2 Norm for regularization
-l2_reg = regularization.regularize_layer_params(NET, regularization.l2) * L2_WEIGHT
-
-#calculate the loss
-if MULTI_LABEL:
-    loss = calc_loss_multi(prediction, targets) + l2_reg
-else:
-    loss = calc_loss(prediction, targets) + l2_reg
-
 ################# ACCURACY FUNCTION #####################
 def calc_accuracy(prediction, targets):
 
@@ -480,94 +1626,645 @@ def calc_accuracy_multi(prediction, targets):
     
     return a
 
-#calculate accuracy
-if MULTI_LABEL and VAL_HAS_MULTI_LABEL:
-    accuracy = calc_accuracy_multi(prediction, targets)
-else:
-    accuracy = calc_accuracy(prediction, targets)
+###################### GRAPH ############################
+#symbolic expressions are cheap, we build them all at once when the first function is needed
+GRAPH = {}
+def getGraph():
 
-####################### UPDATES #########################
-#we use dynamic learning rates which change after some epochs
-lr_dynamic = T.scalar(name='learning_rate')
-                    
-#get all trainable parameters (weights) of our net
-params = l.get_all_params(NET, trainable=True)
-
-#we use the adam update
-if OPTIMIZER == 'adam':
-    param_updates = updates.adam(loss, params, learning_rate=lr_dynamic, beta1=0.5)
-elif OPTIMIZER == 'nesterov':
-    param_updates = updates.nesterov_momentum(loss, params, learning_rate=lr_dynamic, momentum=0.9)
-
-#################### TRAIN FUNCTION ######################
-#the theano train functions takes images and class targets as input
-print "COMPILING THEANO TRAIN FUNCTION...",
-start = time.time()
-train_net = theano.function([l.get_all_layers(NET)[0].input_var, targets, lr_dynamic], loss, updates=param_updates)
-print "DONE! (", int(time.time() - start), "s )"
-
-################# PREDICTION FUNCTION ####################
-#we need the prediction function to calculate the validation accuracy
-#this way we can test the net during/after training
-net_output = l.get_output(NET, deterministic=True)
-
-print "COMPILING THEANO TEST FUNCTION...",
-start = time.time()
-test_net = theano.function([l.get_all_layers(NET)[0].input_var, targets], [net_output, loss, accuracy])
-print "DONE! (", int(time.time() - start), "s )"
+    if len(GRAPH) == 0:
 
-################## CONFUSION MATRIX #####################
-cmatrix = []
-def clearConfusionMatrix():
+        net = getNet()
 
-    global cmatrix
+        #theano variables for the input images and the class targets
+        GRAPH['input'] = l.get_all_layers(net)[0].input_var
+        GRAPH['targets'] = T.matrix('targets', dtype=theano.config.floatX)
 
-    #allocate empty matrix
-    cmatrix = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype='int32')
+        #get the network output
+        GRAPH['prediction'] = l.get_output(net)
 
-def updateConfusionMatrix(p, t):
+        #we use L2 Norm for regularization
+        l2_reg = regularization.regularize_layer_params(net, regularization.l2) * L2_WEIGHT
 
-    global cmatrix
+        #calculate the loss
+        if MULTI_LABEL:
+            GRAPH['loss'] = calc_loss_multi(GRAPH['prediction'], GRAPH['targets']) + l2_reg
+        else:
+            GRAPH['loss'] = calc_loss(GRAPH['prediction'], GRAPH['targets']) + l2_reg
+
+        #calculate accuracy
+        if MULTI_LABEL and VAL_HAS_MULTI_LABEL:
+            GRAPH['accuracy'] = calc_accuracy_multi(GRAPH['prediction'], GRAPH['targets'])
+        else:
+            GRAPH['accuracy'] = calc_accuracy(GRAPH['prediction'], GRAPH['targets'])
+
+        #we need the deterministic output to test the net during/after training
+        GRAPH['net_output'] = l.get_output(net, deterministic=True)
+
+        #we use dynamic learning rates which change after some epochs
+        GRAPH['lr_dynamic'] = T.scalar(name='learning_rate')
+
+    return GRAPH
+
+####################### UPDATES #########################
+OPTIMIZER_STATE = []
+PENDING_OPTIMIZER_STATE = None
+def getUpdates(loss_or_grads=None):
+
+    graph = getGraph()
+
+    #get all trainable parameters (weights) of our net
+    params = l.get_all_params(getNet(), trainable=True)
+
+    #data-parallel training passes the reduced gradients of all workers
+    if loss_or_grads == None:
+        loss_or_grads = graph['loss']
+
+    #we use the adam update
+    if OPTIMIZER == 'adam':
+        param_updates = updates.adam(loss_or_grads, params, learning_rate=graph['lr_dynamic'], beta1=0.5)
+    elif OPTIMIZER == 'nesterov':
+        param_updates = updates.nesterov_momentum(loss_or_grads, params, learning_rate=graph['lr_dynamic'], momentum=0.9)
+
+    #all updated variables which are no params are optimizer state (e.g. adam moments)
+    param_ids = set([id(p) for p in params])
+    del OPTIMIZER_STATE[:]
+    OPTIMIZER_STATE.extend([v for v in param_updates.keys() if id(v) not in param_ids])
+
+    #restore optimizer state from checkpoint?
+    if PENDING_OPTIMIZER_STATE != None:
+        if len(PENDING_OPTIMIZER_STATE) == len(OPTIMIZER_STATE):
+            for v, value in zip(OPTIMIZER_STATE, PENDING_OPTIMIZER_STATE):
+                v.set_value(np.array(value, dtype=v.dtype))
+        else:
+            print "OPTIMIZER STATE DOES NOT MATCH, WE START WITH A FRESH OPTIMIZER"
+
+    return param_updates
+
+#################### THEANO FUNCTIONS ####################
+#every function gets compiled on first use, so inference only compiles the prediction graph
+FUNCTIONS = {}
+def compileFunction(name, inputs, outputs, updates=None):
+
+    #theano module cache counters: [hits, loads from disk, compiles]
+    cache = theano.gof.cc.get_module_cache()
+    stats = list(cache.stats)
+
+    print "COMPILING THEANO", name.upper(), "FUNCTION...",
+    start = time.time()
+    f = theano.function(inputs, outputs, updates=updates)
+    print "DONE! (", int(time.time() - start), "s )",
+
+    #how much did we get from the compile cache in theano.config.compiledir?
+    reused = (cache.stats[0] - stats[0]) + (cache.stats[1] - stats[1])
+    compiled = cache.stats[2] - stats[2]
+    print "MODULES REUSED:", reused, "COMPILED:", compiled
+
+    return f
+
+def getTrainFunction():
+
+    #the theano train functions takes images and class targets as input
+    if 'train' not in FUNCTIONS:
+        graph = getGraph()
+        FUNCTIONS['train'] = compileFunction('train', [graph['input'], graph['targets'], graph['lr_dynamic']], graph['loss'], updates=getUpdates())
+
+    return FUNCTIONS['train']
+
+def getTestFunction():
+
+    #we need the test function to calculate the validation accuracy
+    if 'test' not in FUNCTIONS:
+        graph = getGraph()
+        FUNCTIONS['test'] = compileFunction('test', [graph['input'], graph['targets']], [graph['net_output'], graph['loss'], graph['accuracy']])
+
+    return FUNCTIONS['test']
+
+def getPredictionFunction():
+
+    #for inference we do not have any targets
+    if 'predict' not in FUNCTIONS:
+
+        #ensemble or exported model without batch norm?
+        if len(ENSEMBLE_MODELS) > 0:
+            FUNCTIONS['predict'] = predictEnsemble
+        elif INFERENCE_MODEL != None:
+            FUNCTIONS['predict'] = getInferenceFunction(loadInferenceModel(MODEL_PATH + INFERENCE_MODEL))
+        else:
+            graph = getGraph()
+            FUNCTIONS['predict'] = compileFunction('prediction', [graph['input']], graph['net_output'])
+
+    return FUNCTIONS['predict']
+
+################ DATA-PARALLEL TRAINING #################
+#every batch is split into shards, forked processes compute the gradients of their shard and write them to shared memory
+#the main process reduces the gradients, applies the adam/nesterov updates and publishes the new params
+#(set OMP_NUM_THREADS so that all processes together do not use more threads than there are cores)
+DP_POOL = None
+DP_LAYOUT = []
+DP_BUFFERS = {}
+DP_STATS = {}
+DP_STEP = 0
+def getParallelTrainFunction():
+
+    global DP_POOL
+
+    if DP_POOL == None:
+
+        graph = getGraph()
+
+        #all params including batch norm statistics, every param has its place in the flat buffers
+        trainable = l.get_all_params(getNet(), trainable=True)
+        trainable_ids = set([id(p) for p in trainable])
+        offset = 0
+        for p in l.get_all_params(getNet()):
+            shape = p.get_value(borrow=True).shape
+            size = int(np.prod(shape))
+            DP_LAYOUT.append((p, offset, size, shape, id(p) in trainable_ids))
+            offset += size
+
+        #gradients of one shard (batch norm statistics get updated when the function is called)
+        FUNCTIONS['gradients'] = compileFunction('gradients', [graph['input'], graph['targets']], [graph['loss']] + T.grad(graph['loss'], trainable))
+
+        #updates are applied to the reduced gradients
+        grads = [p.type() for p in trainable]
+        FUNCTIONS['apply'] = compileFunction('apply updates', grads + [graph['lr_dynamic']], [], updates=getUpdates(grads))
+
+        #shared memory for batches, params and one gradient buffer per shard
+        DP_BUFFERS['x'] = np.frombuffer(multiprocessing.RawArray('f', BATCH_SIZE * IM_DIM * IM_SIZE[1] * IM_SIZE[0]), dtype='float32').reshape(BATCH_SIZE, IM_DIM, IM_SIZE[1], IM_SIZE[0])
+        DP_BUFFERS['y'] = np.frombuffer(multiprocessing.RawArray('f', BATCH_SIZE * NUM_CLASSES), dtype='float32').reshape(BATCH_SIZE, NUM_CLASSES)
+        DP_BUFFERS['params'] = np.frombuffer(multiprocessing.RawArray('f', offset), dtype='float32')
+        DP_BUFFERS['grads'] = np.frombuffer(multiprocessing.RawArray('f', TRAIN_PROCESSES * offset), dtype='float32').reshape(TRAIN_PROCESSES, offset)
+        publishParams()
+
+        #workers inherit compiled functions and buffers
+        DP_POOL = multiprocessing.Pool(TRAIN_PROCESSES, initWorker)
+
+    return trainDataParallel
+
+def publishParams():
+
+    for p, offset, size, shape, trainable in DP_LAYOUT:
+        DP_BUFFERS['params'][offset:offset + size] = p.get_value(borrow=True).ravel()
+
+def trainShard(task):
+
+    rank, start, end, step = task
+    start_time = time.time()
+
+    #params of the last step
+    for p, offset, size, shape, trainable in DP_LAYOUT:
+        p.set_value(DP_BUFFERS['params'][offset:offset + size].reshape(shape).astype(p.dtype))
+
+    #different dropout masks for every shard and step, but reproducible
+    seed = np.random.RandomState([RANDOM_SEED, step, rank]).randint(1, 2**30)
+    for layer in l.get_all_layers(getNet()):
+        if hasattr(layer, '_srng'):
+            layer._srng.seed(seed)
+
+    #gradients are weighted with the shard size, batch norm statistics as well
+    n = end - start
+    outputs = FUNCTIONS['gradients'](DP_BUFFERS['x'][start:end], DP_BUFFERS['y'][start:end])
+    grads = iter(outputs[1:])
+    for p, offset, size, shape, trainable in DP_LAYOUT:
+        if trainable:
+            DP_BUFFERS['grads'][rank, offset:offset + size] = next(grads).ravel() * n
+        else:
+            DP_BUFFERS['grads'][rank, offset:offset + size] = p.get_value(borrow=True).ravel() * n
+
+    return float(outputs[0]), n, time.time() - start_time
+
+def trainDataParallel(x, y, lr):
+
+    global DP_STEP
+
+    #batch goes into shared memory once, shards are slices of it
+    n = x.shape[0]
+    DP_BUFFERS['x'][:n] = x
+    DP_BUFFERS['y'][:n] = y
+    bounds = np.linspace(0, n, TRAIN_PROCESSES + 1).astype('int')
+    tasks = [(rank, bounds[rank], bounds[rank + 1], DP_STEP) for rank in xrange(TRAIN_PROCESSES) if bounds[rank + 1] > bounds[rank]]
+    results = DP_POOL.map(trainShard, tasks, chunksize=1)
+    DP_STEP += 1
+
+    #reduce: weighted mean of all shards
+    start = time.time()
+    reduced = np.sum(DP_BUFFERS['grads'][:len(tasks)], axis=0) / n
+
+    #updates for trainable params, mean batch norm statistics for all others
+    grads = []
+    for p, offset, size, shape, trainable in DP_LAYOUT:
+        value = reduced[offset:offset + size].reshape(shape).astype(p.dtype)
+        if trainable:
+            grads.append(value)
+        else:
+            p.set_value(value)
+    FUNCTIONS['apply'](*(grads + [lr]))
+    publishParams()
+
+    #throughput per worker (shard rank) and time for reduce and update
+    for task, (loss, samples, duration) in zip(tasks, results):
+        s = DP_STATS.setdefault(task[0], [0.0, 0])
+        s[0] += duration
+        s[1] += samples
+    s = DP_STATS.setdefault('reduce', [0.0, 0])
+    s[0] += time.time() - start
+    s[1] += 1
+
+    return np.float32(sum([loss * samples for loss, samples, duration in results]) / n)
+
+def showDataParallelStats():
+
+    global DP_STATS
+
+    if len(DP_STATS) == 0:
+        return
+
+    for rank in sorted([k for k in DP_STATS if k != 'reduce']):
+        print "WORKER", str(rank) + ":", int(DP_STATS[rank][1] / max(DP_STATS[rank][0], 1e-8)), "samples/s",
+    print "REDUCE+UPDATE:", int(DP_STATS['reduce'][0] * 1000 / max(1, DP_STATS['reduce'][1])), "ms"
+
+    DP_STATS = {}
+
+################### INFERENCE EXPORT ####################
+#for cpu inference we fold batch norm into conv/dense weights and store weights with reduced precision
+def getFoldedLayers(net):
+
+    #list of (layer spec, params) without batch norm and dropout
+    layers = []
+    for layer in l.get_all_layers(net)[1:]:
+
+        if isinstance(layer, l.Conv2DLayer):
+            spec = {'type':'conv',
+                    'num_filters':layer.num_filters,
+                    'filter_size':list(layer.filter_size),
+                    'stride':list(layer.stride),
+                    'pad':layer.pad if isinstance(layer.pad, str) else list(layer.pad),
+                    'flip_filters':layer.flip_filters}
+        elif isinstance(layer, l.DenseLayer):
+            spec = {'type':'dense', 'num_units':layer.num_units}
+        elif isinstance(layer, l.MaxPool2DLayer):
+            layers.append(({'type':'pool',
+                            'pool_size':list(layer.pool_size),
+                            'stride':list(layer.stride),
+                            'pad':list(layer.pad),
+                            'ignore_border':layer.ignore_border}, {}))
+            continue
+        elif isinstance(layer, l.BatchNormLayer):
+
+            #y = (x - mean) * gamma * inv_std + beta, we scale the weights of every output channel
+            params = layers[-1][1]
+            scale = layer.gamma.get_value() * layer.inv_std.get_value()
+            if layers[-1][0]['type'] == 'conv':
+                params['W'] = params['W'] * scale[:, np.newaxis, np.newaxis, np.newaxis]
+            else:
+                params['W'] = params['W'] * scale[np.newaxis, :]
+            params['b'] = (params['b'] - layer.mean.get_value()) * scale + layer.beta.get_value()
+            continue
+        elif isinstance(layer, l.NonlinearityLayer):
+            layers[-1][0]['nonlinearity'] = layer.nonlinearity.__name__
+            continue
+        elif isinstance(layer, l.DropoutLayer):
+            continue
+        else:
+            raise ValueError('Cannot export layer: ' + layer.__class__.__name__)
+
+        #conv and dense weights (batch norm layers have no bias)
+        W = layer.W.get_value()
+        if layer.b is None:
+            b = np.zeros(W.shape[0] if spec['type'] == 'conv' else W.shape[1], dtype=W.dtype)
+        else:
+            b = layer.b.get_value()
+        spec['nonlinearity'] = layer.nonlinearity.__name__
+        layers.append((spec, {'W':W, 'b':b}))
+
+    return layers
+
+def quantizeLayers(layers, precision):
+
+    qlayers = []
+    for spec, params in layers:
+
+        params = dict(params)
+        if 'W' in params:
+            W = params['W']
+            if precision == 'int8':
+
+                #symmetric scale per output channel (axis 0 of conv weights, axis 1 of dense weights)
+                if spec['type'] == 'conv':
+                    amax = np.abs(W).reshape(W.shape[0], -1).max(axis=1)
+                    scale = np.maximum(amax / 127.0, 1e-12)
+                    params['W'] = np.round(W / scale[:, np.newaxis, np.newaxis, np.newaxis]).astype('int8')
+                else:
+                    amax = np.abs(W).max(axis=0)
+                    scale = np.maximum(amax / 127.0, 1e-12)
+                    params['W'] = np.round(W / scale[np.newaxis, :]).astype('int8')
+                params['scale'] = scale.astype('float32')
+            elif precision == 'float16':
+                params['W'] = W.astype('float16')
+            else:
+                params['W'] = W.astype('float32')
+            params['b'] = params['b'].astype('float32')
+
+        qlayers.append((spec, params))
+
+    return qlayers
+
+def dequantizeWeights(spec, params):
+
+    W = np.asarray(params['W'], dtype='float32')
+    if 'scale' in params:
+        if spec['type'] == 'conv':
+            W *= params['scale'][:, np.newaxis, np.newaxis, np.newaxis]
+        else:
+            W *= params['scale'][np.newaxis, :]
+
+    return W.astype(theano.config.floatX)
+
+def buildInferenceModel(layers):
+
+    #same input as the full net, but no batch norm and dropout layers
+    net = l.InputLayer((None, IM_DIM, IM_SIZE[1], IM_SIZE[0]))
+    for spec, params in layers:
+        if spec['type'] == 'pool':
+            net = l.MaxPool2DLayer(net, pool_size=spec['pool_size'], stride=spec['stride'], pad=spec['pad'], ignore_border=spec['ignore_border'])
+        elif spec['type'] == 'conv':
+            net = l.Conv2DLayer(net, num_filters=spec['num_filters'], filter_size=spec['filter_size'], stride=spec['stride'], pad=spec['pad'], flip_filters=spec['flip_filters'],
+                                W=dequantizeWeights(spec, params), b=np.asarray(params['b'], dtype=theano.config.floatX), nonlinearity=getattr(nonlinearities, spec['nonlinearity']))
+        else:
+            net = l.DenseLayer(net, spec['num_units'],
+                               W=dequantizeWeights(spec, params), b=np.asarray(params['b'], dtype=theano.config.floatX), nonlinearity=getattr(nonlinearities, spec['nonlinearity']))
+
+    return net
+
+def getInferenceFunction(layers, name='inference'):
+
+    net = buildInferenceModel(layers)
+
+    return compileFunction(name, [l.get_all_layers(net)[0].input_var], l.get_output(net, deterministic=True))
+
+def saveInferenceModel(filename, layers, precision):
+
+    #layer specs go into the header, weights into the array section of a checkpoint
+    arrays = []
+    for i, (spec, params) in enumerate(layers):
+        for key in sorted(params):
+            arrays.append((key + '_' + str(i), params[key]))
+
+    header = {'precision':precision,
+              'layers':[spec for spec, params in layers],
+              'run_name':RUN_NAME,
+              'model_type':MODEL_TYPE,
+              'im_size':list(IM_SIZE),
+              'im_dim':IM_DIM,
+              'classes':CLASSES}
+
+    writeCheckpoint(filename, header, arrays)
+
+def loadInferenceModel(filename):
+
+    print "IMPORTING INFERENCE MODEL...",
+    header, arrays = readCheckpoint(filename)
+    layers = []
+    for i, spec in enumerate(header['layers']):
+        params = {}
+        for key in ['W', 'b', 'scale']:
+            if key + '_' + str(i) in arrays:
+                params[key] = arrays[key + '_' + str(i)]
+        layers.append((spec, params))
+    print "DONE! (", header['precision'], ")"
+
+    return layers
+
+def evaluateInference(predict_net):
+
+    #top-1 accuracy and time per sample on the validation split
+    correct = 0
+    total = 0
+    duration = 0.0
+    for image_batch, target_batch in getNextImageBatch(VAL, False, VAL_HAS_MULTI_LABEL):
+        start = time.time()
+        prediction_batch = predict_net(image_batch)
+        duration += time.time() - start
+        correct += np.sum(np.argmax(prediction_batch, axis=1) == np.argmax(target_batch, axis=1))
+        total += image_batch.shape[0]
+
+    return correct * 100.0 / max(1, total), duration * 1000.0 / max(1, total)
+
+def exportInferenceModel():
+
+    #we need trained params (PRETRAINED_MODEL) and the validation split
+    loadDataset()
+    layers = getFoldedLayers(getNet())
+
+    #compare the full net with folded and quantized versions
+    print "EVALUATING INFERENCE MODELS ON", len(VAL), "VALIDATION SAMPLES..."
+    graph = getGraph()
+    report = []
+    acc, ms = evaluateInference(compileFunction('prediction', [graph['input']], graph['net_output']))
+    report.append({'model':'full float32', 'accuracy':acc, 'ms_per_sample':ms})
+    for precision in ['float32', 'float16', 'int8']:
+        acc, ms = evaluateInference(getInferenceFunction(quantizeLayers(layers, precision), 'inference ' + precision))
+        report.append({'model':'folded ' + precision, 'accuracy':acc, 'ms_per_sample':ms})
+
+    #print report
+    for r in report:
+        r['accuracy_drop'] = report[0]['accuracy'] - r['accuracy']
+        r['speedup'] = report[0]['ms_per_sample'] / max(r['ms_per_sample'], 1e-8)
+        print "\t" + r['model'].upper() + ":", "ACCURACY:", (int(r['accuracy'] * 10) / 10.0), "%", "MS PER SAMPLE:", (int(r['ms_per_sample'] * 100) / 100.0), "SPEEDUP:", (int(r['speedup'] * 100) / 100.0), "x"
+    drop = [r['accuracy_drop'] for r in report if r['model'] == 'folded ' + INFERENCE_PRECISION][0]
+    if drop > EXPORT_TOLERANCE:
+        print "WARNING: ACCURACY DROP OF", INFERENCE_PRECISION.upper(), "MODEL EXCEEDS TOLERANCE:", drop, "%"
+
+    #save report and model
+    if not os.path.exists(MODEL_PATH):
+        os.makedirs(MODEL_PATH)
+    filename = MODEL_PATH + "birdCLEF_" + RUN_NAME + "_inference_" + INFERENCE_PRECISION
+    with open(filename + '_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print "EXPORTING INFERENCE MODEL...",
+    saveInferenceModel(filename + '.ckpt', quantizeLayers(layers, INFERENCE_PRECISION), INFERENCE_PRECISION)
+    print "DONE!"
+
+############### TEST-TIME AUGMENTATION ##################
+#every input gets k fixed variants, all variants of a batch go through the prediction function in one call
+def getTTAVariants(k):
+
+    #(frequency roll, time shift, flip), the original comes first
+    fh = int(IM_SIZE[1] * IM_AUGMENTATION['roll'][1][1]) if IM_AUGMENTATION != None and 'roll' in IM_AUGMENTATION else 0
+    tw = int(IM_SIZE[0] * TTA_TIME_SHIFT)
+    variants = [(0, 0)]
+    for scale in [1.0, 0.5]:
+        variants += [(int(fh * scale), 0), (-int(fh * scale), 0), (0, int(tw * scale)), (0, -int(tw * scale))]
+
+    #no duplicates if a range is 0
+    variants = [v for i, v in enumerate(variants) if v not in variants[:i]]
+    variants = [v + (False,) for v in variants]
+    if TTA_FLIP:
+        variants += [v[:2] + (True,) for v in variants]
+
+    return variants[:k]
+
+def getTTABatch(x, k):
+
+    #one roll/flip per variant for the whole batch, result has all inputs of variant 0 first, then variant 1...
+    variants = getTTAVariants(k)
+    out = np.empty((len(variants),) + x.shape, dtype=x.dtype)
+    for i, (dh, dw, flip) in enumerate(variants):
+        v = x[:, :, :, ::-1] if flip else x
+        if dh != 0 or dw != 0:
+            out[i] = np.roll(v, (dh, dw), axis=(2, 3))
+        else:
+            out[i] = v
+
+    return out.reshape((-1,) + x.shape[1:])
+
+def predictTTA(predict_net, x, k=None):
+
+    if k == None:
+        k = TTA_VARIANTS
+    if k <= 1:
+        return predict_net(x)
+
+    #inputs per call, so that a call never gets more than BATCH_SIZE images
+    n = max(1, BATCH_SIZE // k)
+    predictions = []
+    for i in xrange(0, x.shape[0], n):
+        p = predict_net(getTTABatch(x[i:i + n], k))
+        p = p.reshape(-1, x[i:i + n].shape[0], p.shape[-1])
+        predictions.append(p.max(axis=0) if TTA_POOLING == 'max' else p.mean(axis=0))
+
+    return np.concatenate(predictions)
+
+def evaluateTTA():
+
+    #accuracy, throughput and single input latency for every number of variants
+    loadDataset()
+    predict_net = getPredictionFunction()
+    single = toChannelsFirst(openImage(VAL[0][0]))[np.newaxis]
+
+    print "EVALUATING TEST-TIME AUGMENTATION ON", len(VAL), "VALIDATION SAMPLES..."
+    report = []
+    for k in TTA_EVAL_VARIANTS:
+        acc, ms = evaluateInference(lambda batch: predictTTA(predict_net, batch, k))
+
+        #median latency of a single input
+        latency = []
+        for i in xrange(10):
+            start = time.time()
+            predictTTA(predict_net, single, k)
+            latency.append(time.time() - start)
+
+        report.append({'variants':k, 'accuracy':acc, 'ms_per_sample':ms, 'latency_ms':np.median(latency) * 1000})
+        print "\tVARIANTS:", k, "ACCURACY:", (int(acc * 10) / 10.0), "%", "MS PER SAMPLE:", (int(ms * 100) / 100.0), "LATENCY:", (int(report[-1]['latency_ms'] * 100) / 100.0), "ms"
+
+    if not os.path.exists(MODEL_PATH):
+        os.makedirs(MODEL_PATH)
+    with open(MODEL_PATH + "birdCLEF_" + RUN_NAME + "_tta_report.json", 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+################## CONFUSION MATRIX #####################
+cmatrix = []
+def clearConfusionMatrix():
+
+    global cmatrix
+
+    #allocate empty matrix
+    cmatrix = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype='int32')
+
+def updateConfusionMatrix(p, t):
+
+    global cmatrix
 
     #get class indices for prediction and target
     targets = np.argmax(t, axis=1)
     predictions = np.argmax(p, axis=1)
 
-    #add up confusion matrices of validation batches
-    cmatrix += confusion_matrix(targets, predictions, labels=range(0, NUM_CLASSES))
+    #add up predictions of validation batches (row = target, column = prediction)
+    np.add.at(cmatrix, (targets, predictions), 1)
 
-def showConfusionMatrix(epoch):
+PLOT_POOL = None
+PLOT_RESULTS = []
+def getPlotPool():
 
-    #new figure
-    plt.figure(0, figsize=(35, 35), dpi=72)
-    plt.clf()
+    global PLOT_POOL
+
+    #rendering large figures takes a while, so we do that in a separate process
+    if PLOT_POOL == None:
+        PLOT_POOL = multiprocessing.Pool(1, initWorker)
+
+    return PLOT_POOL
+
+def checkPlots(wait=False):
+
+    #errors of background plots would get lost otherwise
+    for result in list(PLOT_RESULTS):
+        if wait or result.ready():
+            PLOT_RESULTS.remove(result)
+            try:
+                result.get()
+            except Exception, e:
+                print "ERROR PLOTTING CONFUSION MATRIX:", e
+
+def finishPlots():
+
+    global PLOT_POOL
+
+    #wait for pending plots
+    if PLOT_POOL != None:
+        checkPlots(True)
+        PLOT_POOL.close()
+        PLOT_POOL.join()
+        PLOT_POOL = None
+
+def showConfusionMatrix(epoch):
 
     #get additional metrics
     pr, re, f1 = calculateMetrics()
 
+    #we only show the first classes
+    k = min(CONFMATRIX_MAX_CLASSES, NUM_CLASSES)
+    cm = cmatrix[:k, :k]
+
     #normalize?
     if NORMALIZE_CONFMATRIX:
-        global cmatrix
-        cmatrix = np.around(cmatrix.astype('float') / cmatrix.sum(axis=1)[:, np.newaxis] * 100.0, decimals=1)
+        cm = np.around(cm.astype('float') / cmatrix[:k].sum(axis=1)[:, np.newaxis] * 100.0, decimals=1)
+
+    title = ('Confusion Matrix\n' +
+             RUN_NAME + ' - Epoch ' + str(epoch) +
+             '\nTrain Samples: ' + str(len(TRAIN)) + ' Validation Samples: ' + str(len(VAL)) +
+             '\nmP: ' + str(np.mean(pr)) + ' mF1: ' + str(np.mean(f1)))
+
+    #render plot
+    if CONFMATRIX_BACKGROUND:
+        checkPlots()
+        PLOT_RESULTS.append(getPlotPool().apply_async(plotConfusionMatrix, (cm, CLASSES[:k], title, epoch)))
+    else:
+        plotConfusionMatrix(cm, CLASSES[:k], title, epoch)
+
+def plotConfusionMatrix(cm, labels, title, epoch):
+
+    #new figure
+    plt.figure(0, figsize=(35, 35), dpi=72)
+    plt.clf()
 
     #show matrix
-    plt.imshow(cmatrix[:CONFMATRIX_MAX_CLASSES, :CONFMATRIX_MAX_CLASSES], interpolation='nearest', cmap=plt.cm.Blues)
-    plt.title('Confusion Matrix\n' +
-              RUN_NAME + ' - Epoch ' + str(epoch) +
-              '\nTrain Samples: ' + str(len(TRAIN)) + ' Validation Samples: ' + str(len(VAL)) +              
-              '\nmP: ' + str(np.mean(pr)) + ' mF1: ' + str( np.mean(f1)), fontsize=22)
+    plt.imshow(cm, interpolation='nearest', cmap=plt.cm.Blues)
+    plt.title(title, fontsize=22)
 
     #tick marks
-    tick_marks = np.arange(min(CONFMATRIX_MAX_CLASSES, NUM_CLASSES))
-    plt.xticks(tick_marks, CLASSES[:CONFMATRIX_MAX_CLASSES], rotation=90)
-    plt.yticks(tick_marks, CLASSES[:CONFMATRIX_MAX_CLASSES])
+    tick_marks = np.arange(len(labels))
+    plt.xticks(tick_marks, labels, rotation=90)
+    plt.yticks(tick_marks, labels)
 
     #labels
-    thresh = cmatrix.max() / 2.
-    for i, j in itertools.product(range(min(CONFMATRIX_MAX_CLASSES, cmatrix.shape[0])), range(min(CONFMATRIX_MAX_CLASSES, cmatrix.shape[1]))):
-        plt.text(j, i, cmatrix[i, j], 
+    thresh = cm.max() / 2.
+    for i, j in itertools.product(range(cm.shape[0]), range(cm.shape[1])):
+        plt.text(j, i, cm[i, j], 
                  horizontalalignment="center", verticalalignment="center",
-                 color="white" if cmatrix[i, j] > thresh else "black", fontsize=8)
+                 color="white" if cm[i, j] > thresh else "black", fontsize=8)
 
     #axes labels
     plt.tight_layout()
@@ -578,54 +2275,32 @@ def showConfusionMatrix(epoch):
     plt.rc('font', size=12)
 
     #save plot
-    global cmcnt
     if not os.path.exists('confmatrix'):
         os.makedirs('confmatrix')
     plt.savefig('confmatrix/' + RUN_NAME + '_' + str(epoch) + '.png')
 
 def calculateMetrics():
 
-    #allocate arrays
-    pr = []
-    re = []
-    f1 = []
-
-    #parse rows and columns of confusion matrix
-    for i in range(0, cmatrix.shape[0]):
-
-        #true positives, false positves, false negatives
-        tp = float(cmatrix[i][i])
-        fp = float(np.sum(cmatrix, axis=1)[i] - tp)
-        fn = float(np.sum(cmatrix, axis=0)[i] - tp)
+    #true positives, false positves, false negatives (one row and one column sum for all classes)
+    tp = np.diag(cmatrix).astype('float')
+    fp = np.sum(cmatrix, axis=1) - tp
+    fn = np.sum(cmatrix, axis=0) - tp
 
-        #precision
-        if tp > 0 or fp > 0:
-            p = tp / (tp + fp)
-        else:
-            p = 0
-        pr.append(p)
+    #precision
+    pr = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 0.0)
 
-        #recall
-        if tp > 0 or fn > 0:
-            r = tp / (tp + fn)
-        else:
-            r = 0
-        re.append(r)
+    #recall
+    re = np.where(tp + fn > 0, tp / np.maximum(tp + fn, 1), 0.0)
 
-        #f1 measure
-        if p > 0 or r > 0:
-            f = 2 * ((p * r) / (p + r))
-        else:
-            f = 0
-        f1.append(f)
+    #f1 measure
+    f1 = np.where(pr + re > 0, 2 * pr * re / np.maximum(pr + re, 1e-8), 0.0)
     
     return pr, re, f1
 
 ###################### PROGRESS #########################
-batches_per_epoch = len(TRAIN + VAL) // BATCH_SIZE + 1
 avg_duration = []
 last_update = -1
-def showProgress(stat, duration, current, end=batches_per_epoch, update_interval=5, simple_mode=False):
+def showProgress(stat, duration, current, end=None, update_interval=5, simple_mode=False):
 
     #epochs might take a lot of time, so we want some kind of progress bar
     #this approach is not very sophisticated, but it does the job :)
@@ -634,6 +2309,10 @@ def showProgress(stat, duration, current, end=batches_per_epoch, update_interval
     global avg_duration
     global last_update
 
+    #train and validation batches
+    if end == None:
+        end = len(TRAIN + VAL) // BATCH_SIZE + 1
+
     #time left
     avg_duration.append(duration)
     avg_duration = avg_duration[-10:]
@@ -661,170 +2340,1445 @@ def showProgress(stat, duration, current, end=batches_per_epoch, update_interval
             print stat.upper() + ": [" + progress + "] BATCHES " + str(current) + "/" + str(end) + " (" + str(p) + "%) - " + str(r) + " min REMAINING\r",
         last_update = p
 
-###################### TRAINING #########################
-print "START TRAINING..."
-train_loss = []
-val_loss = []
-val_accuracy = []
-max_acc = -1
-lr = LEARNING_RATE[LEARNING_RATE.keys()[0]]
-SAVE_MODEL_AFTER_TRAINING = True
+################## STREAMING INFERENCE ##################
+def getWindowStep():
 
-#train for some epochs...
-for epoch in range(EPOCH_START, EPOCHS + 1):
+    #window step in spectrogram columns
+    return max(1, int(IM_SIZE[0] * (1.0 - WINDOW_OVERLAP)))
 
-    try:
+def getAudioWindows(path, first=0, count=None):
 
-        #start timer
-        start = time.time()
+    #the signal is memory-mapped, we only touch the samples of the current window
+    rate, sig = wavfile.read(path, mmap=True)
 
-        #reset confusion matrix
-        clearConfusionMatrix()
+    return getSignalWindows(sig, rate, first, count)
 
-        #adjust learning rate (interpolate or steps)
-        if LR_DESCENT:
-            lr_keys = np.array(LEARNING_RATE.keys() + [EPOCHS], dtype='float32')
-            lr_values = np.array(LEARNING_RATE.values() + [LEARNING_RATE.values()[-1]], dtype='float32')
-            lr_func = interpolate.interp1d(lr_keys, lr_values, kind='linear')
-            lr = np.float32(lr_func(max(LEARNING_RATE.keys()[0], epoch - 1)))
-        else:
-            if epoch in LEARNING_RATE:
-                lr = LEARNING_RATE[epoch]
+def getSignalWindowStarts(length, rate):
 
-        #shuffle dataset (this way we get "new" batches every epoch)
-        if RANDOMIZE_TRAIN_SET:
-            TRAIN = shuffle(TRAIN, random_state=RANDOM)
+    #window starts in samples
+    hop = int(round(SPEC_WINSTEP * rate))
+    wlen = (IM_SIZE[0] - 1) * hop + int(round(SPEC_WINLEN * rate))
+    step = getWindowStep() * hop
 
-        #time
-        bstart = time.time()
-        last_update = -1
+    return xrange(0, max(1, length - wlen + step), step)
 
-        #iterate over train split batches and calculate mean loss for epoch
-        t_l = []
-        bcnt = 0
-        for image_batch, target_batch in threadedBatchGenerator(getNextImageBatch()):            
+def getSignalWindows(sig, rate, first=0, count=None):
 
-            #calling the training functions returns the current loss
-            loss = train_net(image_batch, target_batch, lr)
-            t_l.append(loss)
+    #only windows first to first + count get computed
+    hop = int(round(SPEC_WINSTEP * rate))
+    for start in itertools.islice(getSignalWindowStarts(sig.shape[0], rate), first, first + count if count != None else None):
+        yield start / float(rate), getSpecImage(getAudioWindow(sig, rate, start // hop), rate)
 
-            #exploding gradient and loss is NaN?
-            if t_l != t_l:
-                print "\nERROR: LOSS IS NaN!"
-                break
-            
-            bcnt += 1
+def readSpectrogramImage(path):
 
-            #show progress
-            showProgress("EPOCH " + str(epoch), (time.time() - bstart), bcnt, simple_mode=SIMPLE_LOG_MODE)
-            bstart = time.time()
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE if IM_DIM == 1 else cv2.IMREAD_COLOR)
 
-        #we validate our net every epoch and pass our validation split through as well
-        v_l = []
-        v_a = []
-        for image_batch, target_batch in threadedBatchGenerator(getNextImageBatch(VAL, False, VAL_HAS_MULTI_LABEL)):
+def getImageWindows(path, first=0, count=None):
 
-            #calling the test function returns the net output, loss and accuracy
-            prediction_batch, loss, acc = test_net(image_batch, target_batch)
-            v_l.append(loss)
-            v_a.append(acc)
+    return getSpectrogramWindows(readSpectrogramImage(path), first, count)
 
-            #save predicions and targets for confusion matrix
-            updateConfusionMatrix(prediction_batch, target_batch)
+def getSpectrogramWindowStarts(width):
 
-            bcnt += 1   
+    #window starts in columns
+    step = getWindowStep()
 
-            #show progress
-            showProgress("EPOCH " + str(epoch), (time.time() - bstart), bcnt, simple_mode=SIMPLE_LOG_MODE)
-            bstart = time.time()
+    return xrange(0, max(1, width - IM_SIZE[0] + step), step)
+
+def getSpectrogramWindows(img, first=0, count=None):
+
+    #long spectrogram images: one column per frame, only the height gets resized
+    h, w = img.shape[:2]
+    img = cv2.resize(img, (w, IM_SIZE[1]))
+
+    for start in itertools.islice(getSpectrogramWindowStarts(w), first, first + count if count != None else None):
 
-        #stop timer
-        end = time.time()
+        #pad last window
+        window = img[:, start:start + IM_SIZE[0]]
+        if window.shape[1] < IM_SIZE[0]:
+            window = np.concatenate([window, np.zeros((IM_SIZE[1], IM_SIZE[0] - window.shape[1]) + window.shape[2:], dtype=window.dtype)], axis=1)
 
-        #calculate stats for epoch
-        train_loss.append(np.mean(t_l))
-        val_loss.append(np.mean(v_l))
-        val_accuracy.append(np.mean(v_a))
+        yield start * SPEC_WINSTEP, np.asarray(window / 255., dtype='float32')
+
+def poolPredictions(pooled, p):
+
+    #running mean (sum and count) or max over window predictions
+    if pooled == None:
+        return [p.copy(), 1]
+    if POOLING == 'max':
+        pooled[0] = np.maximum(pooled[0], p)
+    else:
+        pooled[0] += p
+    pooled[1] += 1
+
+    return pooled
+
+def getPooledScores(pooled):
+
+    if POOLING == 'max':
+        return pooled[0]
+    else:
+        return pooled[0] / pooled[1]
+
+def predictFile(path):
+
+    predict_net = getPredictionFunction()
+
+    #windows are streamed, so memory does not depend on the length of the recording
+    if path.lower().endswith('.wav'):
+        windows = getAudioWindows(path)
+    else:
+        windows = getImageWindows(path)
+
+    #we only keep the current segment and the whole file pooled
+    segment = None
+    segment_id = 0
+    pooled_file = None
+    while True:
+
+        #next batch of windows
+        batch = list(itertools.islice(windows, max(1, BATCH_SIZE // TTA_VARIANTS)))
+        if len(batch) == 0:
+            break
+        starts = [b[0] for b in batch]
+        x = np.stack([toChannelsFirst(b[1]) for b in batch])
+
+        #deterministic net output (pooled over test-time augmentation variants)
+        prediction = predictTTA(predict_net, x)
+
+        for start, p in zip(starts, prediction):
+
+            #segment finished?
+            if int(start // SEGMENT_LENGTH) != segment_id and segment != None:
+                yield segment_id * SEGMENT_LENGTH, (segment_id + 1) * SEGMENT_LENGTH, getPooledScores(segment)
+                segment = None
+            segment_id = int(start // SEGMENT_LENGTH)
+
+            segment = poolPredictions(segment, p)
+            pooled_file = poolPredictions(pooled_file, p)
+
+    #last segment and the whole file (segment start/end = None)
+    if segment != None:
+        yield segment_id * SEGMENT_LENGTH, (segment_id + 1) * SEGMENT_LENGTH, getPooledScores(segment)
+    if pooled_file != None:
+        yield None, None, getPooledScores(pooled_file)
+
+def loadCheckpointClasses():
+
+    global CLASSES
+    global NUM_CLASSES
+
+    #checkpoints know their classes, so inference does not need to parse the dataset
+    filename = INFERENCE_MODEL if INFERENCE_MODEL != None else PRETRAINED_MODEL
+    if CLASSES == None and filename != None and not filename.endswith('.pkl'):
+        header, arrays = readCheckpoint(MODEL_PATH + filename)
+        if header.get('classes') != None:
+            CLASSES = [str(c) for c in header['classes']]
+            NUM_CLASSES = len(CLASSES)
+
+def getPredictionClasses():
+
+    #ensembles have their own (merged) class list
+    if len(ENSEMBLE_MODELS) > 0:
+        getEnsemble()
+        return ENSEMBLE_CLASSES
+    else:
+        loadCheckpointClasses()
+        loadDataset()
+        return CLASSES
+
+def predictFiles(paths):
+
+    #we need the class labels
+    classes = getPredictionClasses()
+
+    print "PREDICTING", len(paths), "FILES..."
+
+    if not os.path.exists(PREDICTION_PATH):
+        os.makedirs(PREDICTION_PATH)
+
+    #one line per segment and class: path;start;end;class;score (start and end are empty for file scores)
+    with open(PREDICTION_PATH + RUN_NAME + '_predictions.txt', 'w') as f:
+        for path in paths:
+            start = time.time()
+            for s_start, s_end, scores in predictFile(path):
+                for c in np.argsort(scores)[::-1][:TOP_K]:
+                    f.write(';'.join([path, str(s_start) if s_start != None else '', str(s_end) if s_end != None else '', classes[c], str(scores[c])]) + '\n')
+                if s_start == None:
+                    print path, classes[np.argmax(scores)], "(", int(time.time() - start), "s )"
+
+    print "DONE!"
 
-        #print stats for epoch
-        print "TRAIN LOSS:", train_loss[-1],
-        print "VAL LOSS:", val_loss[-1],
-        print "VAL ACCURACY:", (int(val_accuracy[-1] * 1000) / 10.0), "%",
-        print "LR:", lr,
-        print "TIME:", (int((end - start) * 10) / 10.0), "s"
+##################### BATCH SCORING #####################
+#results are written as columnar .npz shards (file names, top-k class ids, float16 scores)
+#a shard is only listed in the journal after it has been renamed into place, so a resumed job skips exactly those files
+def getScoreFiles():
 
-        #log max accuracy and save best params
-        acc = (int(val_accuracy[-1] * 1000) / 10.0)
-        if  acc > max_acc:
-            max_acc = acc
-            BEST_PARAMS = l.get_all_param_values(NET)
-            BEST_EPOCH = epoch
+    files = []
+    for root, dirs, names in os.walk(SCORE_INPUT_PATH):
+        dirs.sort()
+        for name in sorted(names):
+            if name.lower().rsplit('.', 1)[-1] in ['wav', 'png', 'jpg']:
+                files.append(os.path.relpath(os.path.join(root, name), SCORE_INPUT_PATH))
 
-        #show confusion matrix
-        showConfusionMatrix(epoch)
+    return files
 
-        #save snapshot?
-        if epoch in SNAPSHOT_EPOCHS or SNAPSHOT_EPOCHS[0] == -1:
-            saveParams(epoch)
+def loadScoreJournal():
 
+    #one json line per finished shard
+    done = set()
+    shards = 0
+    if os.path.exists(SCORE_OUTPUT_PATH + 'journal.jsonl'):
+        with open(SCORE_OUTPUT_PATH + 'journal.jsonl', 'r+') as f:
+            journal = f.read()
+
+            #a line cut off by a kill gets removed, new entries start on a fresh line
+            if not journal.endswith('\n'):
+                journal = journal[:journal.rfind('\n') + 1]
+                f.seek(0)
+                f.truncate(len(journal))
+
+            for line in journal.splitlines():
+                done.update(json.loads(line)['files'])
+                shards += 1
+
+    return done, shards
+
+def countScoreWindows(name):
+
+    #runs in reader processes, unreadable files have no windows
+    path = os.path.join(SCORE_INPUT_PATH, name)
+    try:
+        if path.lower().endswith('.wav'):
+            rate, sig = wavfile.read(path, mmap=True)
+            return name, len(getSignalWindowStarts(sig.shape[0], rate))
+        else:
+            return name, len(getSpectrogramWindowStarts(readSpectrogramImage(path).shape[1]))
+    except Exception:
+        return name, 0
+
+def getScoreSlices(counts):
+
+    #files are read in slices of one batch of windows, so memory does not depend on the length of a recording
+    size = max(1, BATCH_SIZE // TTA_VARIANTS)
+    for name, total in counts:
+        if total == 0:
+            yield name, 0, 0, 0
+        for first in xrange(0, total, size):
+            yield name, first, min(size, total - first), total
+
+def readScoreSlice(task):
+
+    #runs in reader processes, a file that fails now has no windows left
+    name, first, count, total = task
+    path = os.path.join(SCORE_INPUT_PATH, name)
+    windows = []
+    if count > 0:
+        try:
+            windows = getAudioWindows(path, first, count) if path.lower().endswith('.wav') else getImageWindows(path, first, count)
+            windows = [toChannelsFirst(w) for start, w in windows]
+        except Exception:
+            windows = []
+
+    return name, first, count, total, windows
+
+def writeScoreShard(shard, names, skipped, scores, num_classes):
+
+    #top-k class ids with descending scores
+    #ensembles have their own number of classes, so we do not use NUM_CLASSES
+    scores = np.array(scores, dtype='float32').reshape((-1, num_classes))
+    k = min(TOP_K, num_classes)
+    top_ids = np.argsort(scores, axis=1)[:, ::-1][:, :k]
+    columns = {'files':np.array(names, dtype='S'),
+               'top_ids':top_ids.astype('int16' if num_classes < 32768 else 'int32'),
+               'top_scores':scores[np.arange(scores.shape[0])[:, None], top_ids].astype('float16')}
+    if SCORE_FULL_VECTORS:
+        columns['scores'] = scores.astype('float16')
+
+    #write to temp file first, then the journal entry
+    filename = SCORE_OUTPUT_PATH + 'shard_%05d.npz' % shard
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.rename(filename + '.tmp', filename)
+    with open(SCORE_OUTPUT_PATH + 'journal.jsonl', 'a') as f:
+        f.write(json.dumps({'shard':os.path.basename(filename), 'files':names + skipped}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def scoreCorpus():
+
+    #we need the class labels
+    classes = getPredictionClasses()
+    predict_net = getPredictionFunction()
+
+    if not os.path.exists(SCORE_OUTPUT_PATH):
+        os.makedirs(SCORE_OUTPUT_PATH)
+    with open(SCORE_OUTPUT_PATH + 'classes.json', 'w') as f:
+        json.dump(classes, f)
+
+    #skip files of finished shards
+    done, shard = loadScoreJournal()
+    files = [n for n in getScoreFiles() if n not in done]
+    print "SCORING", len(files), "FILES (", len(done), "ALREADY DONE )..."
+
+    #readers count the windows of every file, then decode slices of windows while the net scores the previous batch
+    #(at most PREFETCH_BATCHES slices of one batch each are in flight, like prefetched training batches)
+    pool = None
+    if SCORE_READERS > 0:
+        pool = multiprocessing.Pool(SCORE_READERS, initWorker)
+    counts = boundedImap(pool, countScoreWindows, files, max(PREFETCH_BATCHES, SCORE_READERS * 2))
+    reader = boundedImap(pool, readScoreSlice, getScoreSlices(counts), max(PREFETCH_BATCHES, SCORE_READERS))
+
+    #windows of consecutive files share full batches
+    size = max(1, BATCH_SIZE // TTA_VARIANTS)
+    pending = deque()
+    pooled = OrderedDict()
+    names, skipped, scores = [], [], []
+    start = time.time()
+    count = 0
+    finished = False
+    try:
+        while not finished or len(pending) > 0:
+
+            #fill one batch
+            while not finished and len(pending) < size:
+                try:
+                    name, first, num, total, windows = next(reader)
+                except StopIteration:
+                    finished = True
+                    break
+
+                #windows left per file, slices that fail drop their windows
+                if total == 0:
+                    skipped.append(name)
+                    continue
+                if first == 0:
+                    pooled[name] = [None, total]
+                pooled[name][1] -= num - len(windows)
+                pending.extend([(name, w) for w in windows])
+
+            #score windows and pool them per file
+            batch = [pending.popleft() for i in xrange(min(size, len(pending)))]
+            if len(batch) > 0:
+                prediction = predictTTA(predict_net, np.stack([b[1] for b in batch]))
+                for (name, w), p in zip(batch, prediction):
+                    pooled[name][0] = poolPredictions(pooled[name][0], p)
+                    pooled[name][1] -= 1
+
+            #files finish in input order, full shards get written right away
+            while len(pooled) > 0 and pooled.values()[0][1] == 0:
+                name, (pool_scores, n) = pooled.popitem(last=False)
+                if pool_scores == None:
+                    skipped.append(name)
+                    continue
+                names.append(name)
+                scores.append(getPooledScores(pool_scores))
+                count += 1
+                if len(names) + len(skipped) >= SCORE_SHARD_FILES:
+                    writeScoreShard(shard, names, skipped, scores, len(classes))
+                    shard += 1
+                    names, skipped, scores = [], [], []
+                    print "SHARD", shard, "WRITTEN:", count, "FILES SCORED", "(", int(count / max(1e-6, time.time() - start)), "FILES/s )"
+
+        #the rest once all files are done
+        if len(names) + len(skipped) > 0:
+            writeScoreShard(shard, names, skipped, scores, len(classes))
+            print "SHARD", shard + 1, "WRITTEN:", count, "FILES SCORED"
+    finally:
+        if pool != None:
+            reader.close()
+            counts.close()
+            pool.terminate()
+
+    print "DONE! (", int(time.time() - start), "s )"
+
+#################### SCORING SERVER #####################
+#http handlers only cut inputs into windows, one thread merges the windows of all requests into micro-batches
+SERVE_QUEUE = Queue.Queue()
+SERVE_METRICS = {'requests':0, 'windows':0, 'batches':0, 'latency':deque(maxlen=SERVE_METRICS_WINDOW)}
+SERVE_LOCK = threading.Lock()
+def batchWorker(predict_net):
+
+    #test-time augmentation variants count towards the batch size
+    size = max(1, BATCH_SIZE // TTA_VARIANTS)
+    while True:
+
+        #first window blocks, then we wait until the batch is full or the deadline has passed
+        items = [SERVE_QUEUE.get()]
+        deadline = time.time() + SERVE_MAX_WAIT / 1000.0
+        while len(items) < size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(SERVE_QUEUE.get(timeout=timeout))
+            except Queue.Empty:
+                break
+
+        #results go back to the waiting requests
+        try:
+            prediction = predictTTA(predict_net, np.stack([toChannelsFirst(window) for window, result in items]))
+            for (window, result), p in zip(items, prediction):
+                result['scores'] = p
+        except Exception, e:
+            for window, result in items:
+                result['error'] = str(e)
+        for window, result in items:
+            result['event'].set()
+
+        with SERVE_LOCK:
+            SERVE_METRICS['batches'] += 1
+            SERVE_METRICS['windows'] += len(items)
+
+def getRequestWindows(data):
+
+    #wav files or spectrogram images of any length
+    if data[:4] == 'RIFF':
+        rate, sig = wavfile.read(BytesIO(data))
+        return getSignalWindows(sig, rate)
+    else:
+        img = cv2.imdecode(np.frombuffer(data, dtype='uint8'), cv2.IMREAD_GRAYSCALE if IM_DIM == 1 else cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('Input is neither a wav file nor an image')
+        return getSpectrogramWindows(img)
+
+def scoreRequest(data):
+
+    start = time.time()
+
+    #all windows of a request get queued at once, so they can share micro-batches
+    results = []
+    for s_start, window in getRequestWindows(data):
+        result = {'event':threading.Event()}
+        SERVE_QUEUE.put((window, result))
+        results.append(result)
+
+    #pooled scores of all windows
+    pooled = None
+    for result in results:
+        result['event'].wait()
+        if 'error' in result:
+            raise ValueError(result['error'])
+        pooled = poolPredictions(pooled, result['scores'])
+    scores = getPooledScores(pooled)
+
+    latency = time.time() - start
+    with SERVE_LOCK:
+        SERVE_METRICS['requests'] += 1
+        SERVE_METRICS['latency'].append(latency)
+
+    classes = getPredictionClasses()
+    return {'classes':[{'class':classes[c], 'score':float(scores[c])} for c in np.argsort(scores)[::-1][:TOP_K]],
+            'windows':len(results),
+            'latency_ms':latency * 1000}
+
+def getServeMetrics():
+
+    with SERVE_LOCK:
+        latency = np.array(SERVE_METRICS['latency']) * 1000
+        metrics = {'requests':SERVE_METRICS['requests'],
+                   'windows':SERVE_METRICS['windows'],
+                   'batches':SERVE_METRICS['batches'],
+                   'mean_batch_fill':SERVE_METRICS['windows'] / float(max(1, SERVE_METRICS['batches'])) / max(1, BATCH_SIZE // TTA_VARIANTS)}
+    if latency.shape[0] > 0:
+        metrics['p50_ms'] = float(np.percentile(latency, 50))
+        metrics['p99_ms'] = float(np.percentile(latency, 99))
+
+    return metrics
+
+class ScoringHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def sendJSON(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.sendJSON(404, {'error':'unknown path'})
+        try:
+            data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            self.sendJSON(200, scoreRequest(data))
+        except Exception, e:
+            self.sendJSON(400, {'error':str(e)})
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.sendJSON(200, getServeMetrics())
+        else:
+            self.sendJSON(404, {'error':'unknown path'})
+
+    #no log line per request
+    def log_message(self, format, *args):
+        pass
+
+class ScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+def serve():
+
+    #prediction function and classes are loaded once
+    getPredictionClasses()
+    predict_net = getPredictionFunction()
+
+    thread = threading.Thread(target=batchWorker, args=(predict_net,))
+    thread.daemon = True
+    thread.start()
+
+    server = ScoringServer((SERVE_HOST, SERVE_PORT), ScoringHandler)
+    print "SCORING SERVER LISTENING ON", SERVE_HOST + ":" + str(SERVE_PORT)
+    try:
+        server.serve_forever()
     except KeyboardInterrupt:
-        SAVE_MODEL_AFTER_TRAINING = SAVE_AFTER_INTERRUPT
-        break
+        server.server_close()
 
-print "TRAINING DONE!"
-print "MAX ACC: ", max_acc
+###################### EMBEDDINGS #######################
+#activations of the second 512-unit dense layer are our acoustic embeddings
+#the ivf index groups rows by their nearest k-means centroid, queries only search the rows of the closest cells
+KNN = {}
+def getEmbeddingLayer():
 
-#save best model params
-if SAVE_MODEL_AFTER_TRAINING:
-    saveParams(BEST_EPOCH, BEST_PARAMS)
+    #the classifier sits on the dropout of the second dense layer (dropout is off in deterministic mode)
+    return getNet().input_layer
 
+def getEmbeddingFunction():
 
+    if 'embed' not in FUNCTIONS:
+        layer = getEmbeddingLayer()
+        FUNCTIONS['embed'] = compileFunction('embedding', [l.get_all_layers(layer)[0].input_var], l.get_output(layer, deterministic=True))
 
-import os
-from shutil import copyfile
-from sklearn.utils import shuffle
- species and class id
-#Use birdCLEF_sort_data.py in order to sort wav files accordingly
-train_path = 'dataset/train/src/'
+    return FUNCTIONS['embed']
+
+def getEmbeddingName(suffix):
+
+    return EMBEDDING_PATH + "birdCLEF_" + RUN_NAME + "_" + suffix
+
+def readEmbeddingImage(path):
+
+    try:
+        return toChannelsFirst(openImage(path))
+    except:
+        return None
+
+def readEmbeddingBatch(paths):
+
+    #runs in worker processes, unreadable images are left out
+    images = [(path, readEmbeddingImage(path)) for path in paths]
+
+    return [(path, img) for path, img in images if img is not None]
 
-#Specify target folder for validation split
-test_path = 'dataset/val/src/'
+def getEmbeddings(images):
 
-######################################################
+    e = getEmbeddingFunction()(images)
+    if EMBEDDING_NORMALIZE:
+        e /= np.maximum(np.linalg.norm(e, axis=1, keepdims=True), 1e-8)
 
-#get classes from subfolders
-classes = [c for c in sorted(os.listdir(train_path))]
+    return e
 
-#get files for classes
-for c in classes:
+def extractEmbeddings():
 
-    #shuffle files
-    files = shuffle([train_path + c + "/" + f for f in os.listdir(train_path + c)], random_state=1337)
+    loadDataset()
+    paths = [s[0] for s in TRAIN + VAL]
 
-    #choose amount of files for validation split from each class
-    #we want at least 1 sample per class (2 if sample count os between 12 and 20)
-    #we take 10% of the samples if sample count > 20
-    if len(files) <= 12:
-        num_test_files = 1
-    elif len(files) > 12 and len(files) <= 20:
-        num_test_files = 2
+    if not os.path.exists(EMBEDDING_PATH):
+        os.makedirs(EMBEDDING_PATH)
+
+    #one row per sample, unreadable samples leave unused rows at the end
+    size = l.get_output_shape(getEmbeddingLayer())[1]
+    data = np.lib.format.open_memmap(getEmbeddingName('embeddings.npy'), mode='w+', dtype=EMBEDDING_DTYPE, shape=(len(paths), size))
+
+    print "EXTRACTING EMBEDDINGS OF", len(paths), "SAMPLES..."
+    start = time.time()
+
+    #decode batches in worker processes (at most PREFETCH_BATCHES in flight), rows are written in order
+    files = []
+    for batch in boundedImap(getWorkerPool(), readEmbeddingBatch, getDatasetChunk(paths), PREFETCH_BATCHES):
+        if len(batch) == 0:
+            continue
+        data[len(files):len(files) + len(batch)] = getEmbeddings(np.stack([b[1] for b in batch]))
+        files += [b[0] for b in batch]
+    data.flush()
+
+    with open(getEmbeddingName('files.txt'), 'w') as f:
+        f.write('\n'.join(files))
+
+    print "DONE! (", int(time.time() - start), "s ) SKIPPED:", len(paths) - len(files)
+
+def loadEmbeddings():
+
+    #file names and the memory-mapped matrix
+    with open(getEmbeddingName('files.txt'), 'r') as f:
+        files = f.read().splitlines()
+
+    return files, np.load(getEmbeddingName('embeddings.npy'), mmap_mode='r')[:len(files)]
+
+def getNearestCells(x, centroids, n=1):
+
+    #closest centroids (l2) are the ones with the largest x.c - |c|^2 / 2
+    sims = x.dot(centroids.T) - 0.5 * np.sum(centroids ** 2, axis=1)
+    if n == 1:
+        return np.argmax(sims, axis=1)
     else:
-        num_test_files = int(len(files) * 0.1)
+        return np.argpartition(-sims, n - 1, axis=1)[:, :n]
 
-    test_files = files[:num_test_files]
-    print c, len(files), len(test_files)
+def buildKnnIndex(data):
 
-    #copy test files for validation to target folder
-    for tf in test_files:
+    print "BUILDING K-NN INDEX WITH", min(KNN_CELLS, data.shape[0]), "CELLS...",
+    start = time.time()
 
-        #copy test file
-        new_path = tf.replace(train_path, test_path).rsplit("/", 1)[0]
-        if not os.path.exists(new_path):
-            os.makedirs(new_path)
-        copyfile(tf, tf.replace(train_path, test_path))
+    #k-means on a sample of the rows (a few lloyd iterations are enough to balance the cells)
+    cells = min(KNN_CELLS, data.shape[0])
+    x = np.asarray(data[np.sort(RANDOM.choice(data.shape[0], min(data.shape[0], cells * 64), replace=False))], dtype='float32')
+    centroids = x[RANDOM.choice(x.shape[0], cells, replace=False)]
+    for i in xrange(10):
+        assign = getNearestCells(x, centroids)
+        order = np.argsort(assign)
+        used, first = np.unique(assign[order], return_index=True)
+        centroids[used] = np.add.reduceat(x[order], first, axis=0) / np.diff(np.append(first, x.shape[0]))[:, np.newaxis]
 
-        #remove test file from train
-        #Note: You might want to test the script first before deleting any files :)
-        os.remove(tf)
-        
-    #break
+    #rows sorted by cell, the rows of cell c are order[offsets[c]:offsets[c + 1]]
+    assign = np.concatenate([getNearestCells(np.asarray(data[i:i + KNN_BLOCK], dtype='float32'), centroids) for i in xrange(0, data.shape[0], KNN_BLOCK)])
+    order = np.argsort(assign, kind='mergesort').astype('int32')
+    offsets = np.searchsorted(assign[order], np.arange(cells + 1))
+
+    KNN.update({'centroids':centroids, 'order':order, 'offsets':offsets})
+    with open(getEmbeddingName('knn_index.npz'), 'wb') as f:
+        np.savez(f, **KNN)
+
+    print "DONE! (", int(time.time() - start), "s )"
+
+def getKnnIndex():
+
+    if len(KNN) == 0:
+        index = np.load(getEmbeddingName('knn_index.npz'))
+        KNN.update({k:index[k] for k in index.files})
+
+    return KNN
+
+def getTopK(sims, ids, k):
+
+    #best k columns of every row in descending order
+    k = min(k, sims.shape[1])
+    rows = np.arange(sims.shape[0])[:, np.newaxis]
+    best = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    best = best[rows, np.argsort(-sims[rows, best], axis=1)]
+
+    return ids[rows, best] if ids.ndim == 2 else ids[best], sims[rows, best]
+
+def searchExact(data, queries, k):
+
+    #blocked matrix multiply, we only keep the best k of every block
+    ids = np.zeros((queries.shape[0], 0), dtype='int64')
+    sims = np.zeros((queries.shape[0], 0), dtype='float32')
+    for i in xrange(0, data.shape[0], KNN_BLOCK):
+        block = np.asarray(data[i:i + KNN_BLOCK], dtype='float32')
+        b_ids, b_sims = getTopK(queries.dot(block.T), np.arange(i, i + block.shape[0]), k)
+        ids, sims = getTopK(np.concatenate([sims, b_sims], axis=1), np.concatenate([ids, b_ids], axis=1), k)
+
+    return ids, sims
+
+def searchIVF(data, queries, k):
+
+    index = getKnnIndex()
+    order, offsets = index['order'], index['offsets']
+
+    #fewer than k candidates are padded with id -1
+    ids = np.full((queries.shape[0], k), -1, dtype='int64')
+    sims = np.full((queries.shape[0], k), -np.inf, dtype='float32')
+    cells = getNearestCells(queries, index['centroids'], min(KNN_PROBES, index['centroids'].shape[0]))
+    for q in xrange(queries.shape[0]):
+
+        #sorted candidates read the memory map in order
+        candidates = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in cells[q]]))
+        if candidates.shape[0] > 0:
+            q_ids, q_sims = getTopK(np.asarray(data[candidates], dtype='float32').dot(queries[q])[np.newaxis], candidates, k)
+            ids[q, :q_ids.shape[1]] = q_ids[0]
+            sims[q, :q_sims.shape[1]] = q_sims[0]
+
+    return ids, sims
+
+def searchEmbeddings(data, queries, k=KNN_NEIGHBOURS):
+
+    #inner product similarity of float32 queries
+    queries = np.asarray(queries, dtype='float32')
+    if KNN_INDEX == 'ivf':
+        return searchIVF(data, queries, k)
+    else:
+        return searchExact(data, queries, k)
+
+def findSimilar(paths, k=KNN_NEIGHBOURS):
+
+    #nearest neighbours of spectrogram images: [[(file, similarity), ...], ...]
+    files, data = loadEmbeddings()
+    ids, sims = searchEmbeddings(data, getEmbeddings(np.stack([readEmbeddingImage(path) for path in paths])), k)
+
+    return [[(files[i], s) for i, s in zip(q_ids, q_sims) if i >= 0] for q_ids, q_sims in zip(ids, sims)]
+
+def findDuplicates(files, data):
+
+    #near-duplicates land in the same cell, so we only compare rows within cells
+    index = getKnnIndex()
+    order, offsets = index['order'], index['offsets']
+    pairs = 0
+    with open(getEmbeddingName('duplicates.txt'), 'w') as f:
+        for c in xrange(offsets.shape[0] - 1):
+            rows = np.sort(order[offsets[c]:offsets[c + 1]])
+            x = np.asarray(data[rows], dtype='float32')
+
+            #cells can be huge (silence, noise), so a block of rows is compared with the rows that follow it
+            #(at most KNN_BLOCK * 256 similarities at once)
+            size = max(1, KNN_BLOCK * 256 // max(1, x.shape[0]))
+            for start in xrange(0, x.shape[0], size):
+                a, b = np.nonzero(np.triu(x[start:start + size].dot(x[start:].T), 1) >= DUPLICATE_SIMILARITY)
+                for i, j in zip(a + start, b + start):
+                    f.write(';'.join([files[rows[i]], files[rows[j]], str(np.dot(x[i], x[j]))]) + '\n')
+                pairs += a.shape[0]
+
+    print "NEAR-DUPLICATE PAIRS:", pairs
+
+def buildEmbeddingIndex():
+
+    extractEmbeddings()
+    files, data = loadEmbeddings()
+    buildKnnIndex(data)
+
+    #latency per query and recall of the ivf index (exact search is the reference)
+    queries = np.asarray(data[np.sort(RANDOM.choice(data.shape[0], min(100, data.shape[0]), replace=False))], dtype='float32')
+    start = time.time()
+    exact_ids, exact_sims = searchExact(data, queries, KNN_NEIGHBOURS)
+    exact_ms = (time.time() - start) * 1000.0 / queries.shape[0]
+    start = time.time()
+    ivf_ids, ivf_sims = searchIVF(data, queries, KNN_NEIGHBOURS)
+    ivf_ms = (time.time() - start) * 1000.0 / queries.shape[0]
+    recall = np.mean([len(set(e) & set(i)) / float(len(e)) for e, i in zip(exact_ids, ivf_ids)])
+    print "EXACT SEARCH:", (int(exact_ms * 100) / 100.0), "ms/query", "IVF SEARCH:", (int(ivf_ms * 100) / 100.0), "ms/query", "RECALL@" + str(KNN_NEIGHBOURS) + ":", (int(recall * 1000) / 10.0), "%"
+
+    if DUPLICATE_SIMILARITY != None:
+        findDuplicates(files, data)
+
+    for path, neighbours in zip(EMBEDDING_QUERIES, findSimilar(EMBEDDING_QUERIES) if len(EMBEDDING_QUERIES) > 0 else []):
+        print path
+        for name, sim in neighbours:
+            print "\t", name, sim
+
+####################### ENSEMBLE ########################
+#members are nets trained on different class ranges, sample ranges or model types
+#every batch gets decoded once and passes through all members
+ENSEMBLE = []
+ENSEMBLE_CLASSES = []
+ENSEMBLE_POOL = None
+ENSEMBLE_INPUT = None
+def loadEnsembleMember(filename):
+
+    header, arrays = readCheckpoint(MODEL_PATH + filename)
+
+    #we need the class subset of every member and all members need the same input
+    if header.get('classes') == None:
+        raise ValueError('Checkpoint has no class list: ' + filename)
+    if list(header['im_size']) != list(IM_SIZE) or header['im_dim'] != IM_DIM:
+        raise ValueError('Ensemble members need the same input size: ' + filename)
+
+    print "LOADING ENSEMBLE MEMBER", filename, "WITH", len(header['classes']), "CLASSES..."
+
+    #exported inference model or checkpoint of the full net
+    if 'layers' in header:
+        predict_net = getInferenceFunction(loadInferenceModel(MODEL_PATH + filename), 'ensemble member')
+    else:
+        net = buildModel(header['model_type'], len(header['classes']), header['multi_label'])
+        l.set_all_param_values(net, [arrays['param_' + str(i)] for i in xrange(header['num_params'])])
+        predict_net = compileFunction('ensemble member', [l.get_all_layers(net)[0].input_var], l.get_output(net, deterministic=True))
+
+    return predict_net, header['classes']
+
+def getEnsemble():
+
+    global ENSEMBLE_POOL
+    global ENSEMBLE_INPUT
+
+    if len(ENSEMBLE) == 0:
+
+        #merged class list and index of the member classes in that list
+        members = [loadEnsembleMember(filename) for filename in ENSEMBLE_MODELS]
+        ENSEMBLE_CLASSES.extend(sorted(set([c for predict_net, classes in members for c in classes])))
+        class_index = dict([(c, i) for i, c in enumerate(ENSEMBLE_CLASSES)])
+        for predict_net, classes in members:
+            ENSEMBLE.append((predict_net, np.array([class_index[c] for c in classes])))
+
+        print "ENSEMBLE HAS", len(ENSEMBLE), "MEMBERS AND", len(ENSEMBLE_CLASSES), "CLASSES"
+
+        #workers are forked after compiling, they inherit all members and read batches from shared memory
+        if ENSEMBLE_WORKERS > 0:
+            ENSEMBLE_INPUT = multiprocessing.RawArray('f', BATCH_SIZE * IM_DIM * IM_SIZE[1] * IM_SIZE[0])
+            ENSEMBLE_POOL = multiprocessing.Pool(ENSEMBLE_WORKERS, initWorker)
+
+    return ENSEMBLE
+
+def predictEnsembleMember(task):
+
+    #task is (member index, batch shape), batch is in shared memory
+    m, shape = task
+    x = np.frombuffer(ENSEMBLE_INPUT, dtype='float32')[:int(np.prod(shape))].reshape(shape)
+
+    return ENSEMBLE[m][0](x)
+
+def predictEnsemble(x):
+
+    ensemble = getEnsemble()
+
+    #run members concurrently?
+    if ENSEMBLE_POOL != None and x.size <= len(ENSEMBLE_INPUT):
+        np.frombuffer(ENSEMBLE_INPUT, dtype='float32')[:x.size] = x.ravel()
+        predictions = ENSEMBLE_POOL.map(predictEnsembleMember, [(m, x.shape) for m in xrange(len(ensemble))], chunksize=1)
+    else:
+        predictions = [predict_net(x) for predict_net, class_index in ensemble]
+
+    #mean score of all members which know a class
+    scores = np.zeros((x.shape[0], len(ENSEMBLE_CLASSES)), dtype='float32')
+    counts = np.zeros(len(ENSEMBLE_CLASSES), dtype='float32')
+    for p, (predict_net, class_index) in zip(predictions, ensemble):
+        scores[:, class_index] += p
+        counts[class_index] += 1
+
+    return scores / np.maximum(counts, 1)
+
+################### HEAD FINE-TUNING ####################
+#the frozen conv stack runs once per (augmented) sample, only the dense and classification layers get trained on its cached output
+def getBackboneLayer():
+
+    #the last pool layer feeds the dense layers
+    return [layer for layer in l.get_all_layers(getNet()) if isinstance(layer, l.MaxPool2DLayer)][-1]
+
+def getHeadParams(**tags):
+
+    #params of the layers above the backbone
+    backbone = set(l.get_all_params(getBackboneLayer()))
+    return [p for p in l.get_all_params(getNet(), **tags) if p not in backbone]
+
+def getFeatureName(split, suffix):
+
+    return FEATURE_PATH + "birdCLEF_" + RUN_NAME + "_" + split + "_" + suffix
+
+def cacheFeatures(split, samples, copies):
+
+    #cached features are re-used if samples and pretrained model did not change
+    meta = {'samples':[s[0] for s in samples], 'copies':copies, 'model':PRETRAINED_MODEL, 'classes':CLASSES}
+    if os.path.exists(getFeatureName(split, 'meta.json')):
+        with open(getFeatureName(split, 'meta.json'), 'r') as f:
+            cached = json.load(f)
+        if all(cached[k] == meta[k] for k in meta):
+            print "USING CACHED", split.upper(), "FEATURES"
+            return
+
+    if not os.path.exists(FEATURE_PATH):
+        os.makedirs(FEATURE_PATH)
+
+    if 'features' not in FUNCTIONS:
+        layer = getBackboneLayer()
+        FUNCTIONS['features'] = compileFunction('features', [l.get_all_layers(layer)[0].input_var], l.get_output(layer, deterministic=True))
+
+    #float16 features and float32 targets, one row per loaded sample
+    n = len(samples) * copies
+    features = np.lib.format.open_memmap(getFeatureName(split, 'features.npy'), mode='w+', dtype='float16', shape=(n,) + l.get_output_shape(getBackboneLayer())[1:])
+    targets = np.lib.format.open_memmap(getFeatureName(split, 'targets.npy'), mode='w+', dtype='float32', shape=(n, NUM_CLASSES))
+
+    print "CACHING", split.upper(), "FEATURES OF", len(samples), "SAMPLES (", copies, "COPIES )..."
+    start = time.time()
+    rows = 0
+    for copy in xrange(copies):
+        for image_batch, target_batch in getNextImageBatch(samples, copy > 0, MULTI_LABEL and copy > 0):
+            features[rows:rows + image_batch.shape[0]] = FUNCTIONS['features'](image_batch)
+            targets[rows:rows + image_batch.shape[0]] = target_batch
+            rows += image_batch.shape[0]
+    features.flush()
+    targets.flush()
+
+    #meta is written last, an interrupted pass gets repeated
+    meta['rows'] = rows
+    with open(getFeatureName(split, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    print "DONE! (", int(time.time() - start), "s )"
+
+def loadFeatures(split):
+
+    with open(getFeatureName(split, 'meta.json'), 'r') as f:
+        rows = json.load(f)['rows']
+
+    return np.load(getFeatureName(split, 'features.npy'), mmap_mode='r')[:rows], np.load(getFeatureName(split, 'targets.npy'), mmap_mode='r')[:rows]
+
+def getHeadFunctions():
+
+    #the head gets the cached features instead of the backbone output
+    net = getNet()
+    backbone = getBackboneLayer()
+    features = T.tensor4('features', dtype=theano.config.floatX)
+    targets = T.matrix('targets', dtype=theano.config.floatX)
+    prediction = l.get_output(net, {backbone:features})
+    net_output = l.get_output(net, {backbone:features}, deterministic=True)
+
+    #same loss and accuracy as the full net (l2 only on head params)
+    l2_reg = regularization.apply_penalty(getHeadParams(regularizable=True), regularization.l2) * L2_WEIGHT
+    if MULTI_LABEL:
+        loss = calc_loss_multi(prediction, targets) + l2_reg
+        val_loss = calc_loss_multi(net_output, targets)
+    else:
+        loss = calc_loss(prediction, targets) + l2_reg
+        val_loss = calc_loss(net_output, targets)
+    if MULTI_LABEL and VAL_HAS_MULTI_LABEL:
+        accuracy = calc_accuracy_multi(net_output, targets)
+    else:
+        accuracy = calc_accuracy(net_output, targets)
+
+    #adam updates of head params only
+    param_updates = updates.adam(loss, getHeadParams(trainable=True), learning_rate=FINETUNE_LEARNING_RATE, beta1=0.5)
+    train_net = compileFunction('head train', [features, targets], loss, updates=param_updates)
+    test_net = compileFunction('head test', [features, targets], [val_loss, accuracy])
+
+    return train_net, test_net
+
+def finetuneHead():
+
+    #pretrained backbone, new or pretrained head
+    if PRETRAINED_MODEL == None:
+        raise ValueError('Fine-tuning needs a PRETRAINED_MODEL')
+
+    #we check before the work is done that the result will not overwrite the pretrained model
+    if os.path.abspath(MODEL_PATH + PRETRAINED_MODEL) in [os.path.abspath(getFinetunedCheckpointName(e)) for e in xrange(FINETUNE_EPOCHS + 1)]:
+        raise ValueError('Fine-tuned checkpoint would overwrite PRETRAINED_MODEL: ' + PRETRAINED_MODEL)
+    loadDataset()
+    getNet()
+    cacheFeatures('train', TRAIN, FEATURE_COPIES)
+    cacheFeatures('val', VAL, 1)
+    train_x, train_y = loadFeatures('train')
+    val_x, val_y = loadFeatures('val')
+    train_net, test_net = getHeadFunctions()
+
+    print "FINE-TUNING HEAD ON", train_x.shape[0], "CACHED FEATURES..."
+    best_params = None
+    best = None
+    best_epoch = 0
+    for epoch in xrange(1, FINETUNE_EPOCHS + 1):
+        start = time.time()
+
+        #shuffled batches, sorted rows read the memory map in order
+        order = RANDOM.permutation(train_x.shape[0])
+        loss = []
+        for i in xrange(0, order.shape[0], BATCH_SIZE):
+            rows = np.sort(order[i:i + BATCH_SIZE])
+            loss.append(train_net(np.asarray(train_x[rows], dtype=theano.config.floatX), np.asarray(train_y[rows], dtype=theano.config.floatX)))
+
+        #validation
+        val_loss = []
+        val_acc = []
+        for i in xrange(0, val_x.shape[0], BATCH_SIZE):
+            l_val, a_val = test_net(np.asarray(val_x[i:i + BATCH_SIZE], dtype=theano.config.floatX), np.asarray(val_y[i:i + BATCH_SIZE], dtype=theano.config.floatX))
+            val_loss.append(l_val * val_x[i:i + BATCH_SIZE].shape[0])
+            val_acc.append(a_val * val_x[i:i + BATCH_SIZE].shape[0])
+        val_loss = np.sum(val_loss) / max(1, val_x.shape[0])
+        val_acc = np.sum(val_acc) * 100.0 / max(1, val_x.shape[0])
+
+        print "EPOCH:", epoch, "TRAIN LOSS:", np.mean(loss), "VAL LOSS:", val_loss, "VAL ACCURACY:", (int(val_acc * 10) / 10.0), "%", "TIME:", int(time.time() - start), "s"
+
+        #we keep the params of the best epoch (BEST_METRIC like in training)
+        value = val_loss if BEST_METRIC == 'val_loss' else val_acc
+        if isImprovement(value, best):
+            best = value
+            best_epoch = epoch
+            best_params = l.get_all_param_values(getNet())
+
+    #normal checkpoint of the whole net (frozen backbone + fine-tuned head)
+    print "BEST EPOCH:", best_epoch, BEST_METRIC.upper() + ":", best
+    saveParams(best_epoch, params=best_params, filename=getFinetunedCheckpointName(best_epoch))
+    waitForSnapshots()
+
+###################### TRAINING #########################
+def isImprovement(value, best):
+
+    if best == None:
+        return True
+    elif BEST_METRIC == 'val_loss':
+        return value < best - MIN_DELTA
+    else:
+        return value > best + MIN_DELTA
+
+def train():
+
+    global BEST_EPOCH
+    global last_update
+
+    #we need the dataset and the compiled train and test functions
+    loadDataset()
+    if TRAIN_PROCESSES > 1:
+        train_net = getParallelTrainFunction()
+    else:
+        train_net = getTrainFunction()
+    test_net = getTestFunction()
+
+    #augmentation throughput and batch assembly time
+    if RUN_BENCHMARKS:
+        benchmarkAugmentation()
+        benchmarkBatchAssembly()
+
+        #benchmark timings should not show up in the profile of the first epoch
+        popTimings()
+
+    print "START TRAINING..."
+    train_loss = []
+    val_loss = []
+    val_accuracy = []
+    max_acc = -1
+    lr = LEARNING_RATE[LEARNING_RATE.keys()[0]]
+    SAVE_MODEL_AFTER_TRAINING = True
+
+    #validation scheduler state: the lr schedule runs on its own epoch counter, which plateaus can move forward
+    best_metric = None
+    bad_validations = 0
+    plateau_validations = 0
+    lr_epoch = EPOCH_START
+    train_time = []
+    val_time = [0.0, 0]
+    skipped_val_samples = 0
+    skipped_epochs = 0
+
+    #train for some epochs...
+    for epoch in range(EPOCH_START, EPOCHS + 1):
+
+        try:
+
+            #start timer
+            start = time.time()
+
+            #reset confusion matrix
+            clearConfusionMatrix()
+
+            #adjust learning rate (interpolate or steps)
+            if LR_DESCENT:
+                lr_keys = np.array(LEARNING_RATE.keys() + [EPOCHS], dtype='float32')
+                lr_values = np.array(LEARNING_RATE.values() + [LEARNING_RATE.values()[-1]], dtype='float32')
+                lr_func = interpolate.interp1d(lr_keys, lr_values, kind='linear')
+                lr = np.float32(lr_func(min(EPOCHS, max(LEARNING_RATE.keys()[0], lr_epoch - 1))))
+            else:
+                if lr_epoch in LEARNING_RATE:
+                    lr = LEARNING_RATE[lr_epoch]
+
+            #validate this epoch? full VAL or subset
+            validate = epoch % VALIDATION_INTERVAL == 0 or epoch == EPOCHS
+            if not validate:
+                val_split = []
+            elif epoch < EPOCHS and VAL_SUBSAMPLE < 1.0:
+                val_split = VAL[:max(1, int(len(VAL) * VAL_SUBSAMPLE))]
+            else:
+                val_split = VAL
+            skipped_val_samples += len(VAL) - len(val_split)
+
+            #balanced sample ids, shuffled (this way we get "new" batches every epoch)
+            #the epoch samples are references to TRAIN entries, the order only depends on the random state (which we checkpoint)
+            ids = getBalancedSampleIds(TRAIN, RANDOMIZE_TRAIN_SET)
+            epoch_samples = [TRAIN[i] for i in ids]
+            num_batches = (len(epoch_samples) + BATCH_SIZE - 1) // BATCH_SIZE + (len(val_split) + BATCH_SIZE - 1) // BATCH_SIZE
+
+            #time
+            bstart = time.time()
+            last_update = -1
+
+            #iterate over train split batches and calculate mean loss for epoch
+            t_l = []
+            bcnt = 0
+            t_samples = 0
+            for image_batch, target_batch in getNextImageBatch(epoch_samples):
+
+                #time we waited for this batch
+                addTiming('wait', bstart)
+                profileBatch(epoch, bcnt)
+
+                #calling the training functions returns the current loss (theano returns after the device is done)
+                tstart = time.time()
+                loss = train_net(image_batch, target_batch, lr)
+                addTiming('train_step', tstart, image_batch.shape[0])
+                t_l.append(loss)
+                t_samples += image_batch.shape[0]
+
+                #exploding gradient and loss is NaN?
+                if t_l != t_l:
+                    print "\nERROR: LOSS IS NaN!"
+                    break
+                
+                bcnt += 1
+
+                #show progress
+                showProgress("EPOCH " + str(epoch), (time.time() - bstart), bcnt, num_batches, simple_mode=SIMPLE_LOG_MODE)
+                bstart = time.time()
+
+            #stop profiler if the epoch ended before the last profiled batch
+            stopProfiler(epoch)
+            train_time.append(time.time() - start)
+
+            #we validate our net (every VALIDATION_INTERVAL epochs) and pass our validation split through as well
+            v_l = []
+            v_a = []
+            v_samples = 0
+            vstart = time.time()
+            for image_batch, target_batch in getNextImageBatch(val_split, False, VAL_HAS_MULTI_LABEL):
+
+                #calling the test function returns the net output, loss and accuracy
+                addTiming('wait', bstart)
+                tstart = time.time()
+                prediction_batch, loss, acc = test_net(image_batch, target_batch)
+                addTiming('test_step', tstart, image_batch.shape[0])
+                v_l.append(loss)
+                v_a.append(acc)
+                v_samples += image_batch.shape[0]
+
+                #save predicions and targets for confusion matrix
+                updateConfusionMatrix(prediction_batch, target_batch)
+
+                bcnt += 1   
+
+                #show progress
+                showProgress("EPOCH " + str(epoch), (time.time() - bstart), bcnt, num_batches, simple_mode=SIMPLE_LOG_MODE)
+                bstart = time.time()
+
+            #stop timer
+            end = time.time()
+            if validate:
+                val_time[0] += end - vstart
+                val_time[1] += v_samples
+
+            #calculate stats for epoch
+            train_loss.append(np.mean(t_l))
+            if validate:
+                val_loss.append(np.mean(v_l))
+                val_accuracy.append(np.mean(v_a))
+
+            #print stats for epoch
+            print "TRAIN LOSS:", train_loss[-1],
+            if validate:
+                print "VAL LOSS:", val_loss[-1],
+                print "VAL ACCURACY:", (int(val_accuracy[-1] * 1000) / 10.0), "%",
+                if len(val_split) < len(VAL):
+                    print "(" + str(len(val_split)), "SAMPLES)",
+            else:
+                print "VAL: SKIPPED",
+            print "LR:", lr,
+            print "TIME:", (int((end - start) * 10) / 10.0), "s"
+
+            #log max accuracy and save best params (by BEST_METRIC)
+            if validate:
+                max_acc = max(max_acc, (int(val_accuracy[-1] * 1000) / 10.0))
+                metric = val_loss[-1] if BEST_METRIC == 'val_loss' else val_accuracy[-1]
+                if isImprovement(metric, best_metric):
+                    best_metric = metric
+                    bad_validations = 0
+                    plateau_validations = 0
+                    BEST_EPOCH = epoch
+
+                    #we keep best params on disk, not in RAM
+                    saveParams(epoch, filename=getBestCheckpointName())
+                else:
+                    bad_validations += 1
+                    plateau_validations += 1
+
+            #plateau? learning rate schedule jumps to the next key
+            lr_epoch += 1
+            if LR_ON_PLATEAU and plateau_validations >= LR_PLATEAU_PATIENCE:
+                next_keys = [k for k in sorted(LEARNING_RATE.keys()) if k >= lr_epoch]
+                if len(next_keys) > 0:
+                    print "PLATEAU! LEARNING RATE SCHEDULE JUMPS TO EPOCH", next_keys[0]
+
+                    #interpolation uses the previous epoch, so we go one further to reach the lr of that key
+                    lr_epoch = next_keys[0] + 1 if LR_DESCENT else next_keys[0]
+                plateau_validations = 0
+
+            #stage timings (before cache stats get reset)
+            logEpochProfile(epoch, end - start, t_samples, v_samples)
+
+            #show cache stats and throughput of data-parallel workers
+            showCacheStats()
+            showDataParallelStats()
+
+            #show confusion matrix
+            if validate and (not CONFMATRIX_SNAPSHOT_ONLY or epoch in SNAPSHOT_EPOCHS or SNAPSHOT_EPOCHS[0] == -1):
+                showConfusionMatrix(epoch)
+
+            #save snapshot?
+            if epoch in SNAPSHOT_EPOCHS or SNAPSHOT_EPOCHS[0] == -1:
+                saveParams(epoch)
+
+            #early stopping?
+            if EARLY_STOPPING_PATIENCE != None and bad_validations >= EARLY_STOPPING_PATIENCE:
+                skipped_epochs = EPOCHS - epoch
+                print "EARLY STOPPING! NO IMPROVEMENT OF", BEST_METRIC.upper(), "FOR", bad_validations, "VALIDATIONS"
+                break
+
+        except KeyboardInterrupt:
+            SAVE_MODEL_AFTER_TRAINING = SAVE_AFTER_INTERRUPT
+            waitForSnapshots()
+            break
+
+    print "TRAINING DONE!"
+    print "MAX ACC: ", max_acc
+
+    #estimated wall-clock time we saved by skipping epochs and validation samples
+    val_rate = val_time[0] / max(1, val_time[1])
+    saved = skipped_epochs * (np.mean(train_time) + len(VAL) * val_rate) + skipped_val_samples * val_rate if len(train_time) > 0 else 0.0
+    print "SCHEDULER SAVED:", (int(saved / 6) / 10.0), "min", "(", skipped_epochs, "EPOCHS,", skipped_val_samples, "VALIDATION SAMPLES )"
+
+    #save best model params
+    waitForSnapshots()
+    if SAVE_MODEL_AFTER_TRAINING:
+        if os.path.exists(getBestCheckpointName()):
+            os.rename(getBestCheckpointName(), getCheckpointName(BEST_EPOCH))
+        else:
+            saveParams(BEST_EPOCH)
+        waitForSnapshots()
+
+    #wait for confusion matrix plots
+    finishPlots()
+
+####################### BENCHMARK #######################
+#every run measures the same synthetic data, so results of different versions are comparable
+def makeSyntheticDataset(path):
+
+    rng = np.random.RandomState(RANDOM_SEED)
+
+    #class subfolders like DATASET_PATH and a noise folder like NOISE_PATH
+    folders = [os.path.join(path, 'train', 'class_' + str(c).zfill(3)) for c in xrange(BENCHMARK_CLASSES)] + [os.path.join(path, 'noise')]
+    for i, folder in enumerate(folders):
+        if os.path.exists(folder):
+            continue
+        os.makedirs(folder)
+        for j in xrange(BENCHMARK_SAMPLES_PER_CLASS):
+
+            #background noise with a few "calls" in a class specific frequency band (noise samples have none)
+            img = rng.normal(20, 10, (IM_SIZE[1], IM_SIZE[0]))
+            if i < BENCHMARK_CLASSES:
+                f = int((i + 0.5) * IM_SIZE[1] / BENCHMARK_CLASSES)
+                for start in rng.randint(0, IM_SIZE[0] - 32, 4):
+                    img[max(0, f - 4):f + 4, start:start + 32] += rng.uniform(100, 200)
+            cv2.imwrite(os.path.join(folder, str(j).zfill(4) + '.png'), np.clip(img, 0, 255).astype('uint8'))
+
+def benchmarkStage(results, name, func, samples, repeats=BENCHMARK_REPEATS):
+
+    #first call is a warm-up, every stage starts with the same random state
+    RANDOM.seed(RANDOM_SEED)
+    func()
+    start = time.time()
+    for i in xrange(repeats):
+        func()
+    duration = (time.time() - start) / repeats
+
+    #memory high-water mark of the main process so far (linux reports KB)
+    results[name] = {'samples_per_sec':samples / max(duration, 1e-8),
+                     'ms_per_call':duration * 1000,
+                     'samples':samples,
+                     'repeats':repeats,
+                     'max_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+    print "\t" + name.upper() + ":", int(results[name]['samples_per_sec']), "samples/s",
+    print (int(duration * 10000) / 10.0), "ms", "MAX RSS:", int(results[name]['max_rss_mb']), "MB"
+
+def resetModel(mtype):
+
+    global MODEL_TYPE
+    global NET
+
+    #model, graph and functions get rebuilt on next use
+    MODEL_TYPE = mtype
+    NET = None
+    GRAPH.clear()
+    FUNCTIONS.clear()
+
+def runBenchmarks():
+
+    global DATASET_PATH
+    global NOISE_PATH
+    global DATASET_INDEX
+    global SHARD_PATH
+    global PRETRAINED_MODEL
+    global AUDIO_INPUT
+    global SPLIT_MANIFEST
+    global CLASS_NAMES
+    global MAX_CLASSES
+    global CLASS_RANGE
+    global SAMPLE_RANGE
+    global MAX_SAMPLES
+    global MAX_VAL_SAMPLES
+
+    #benchmark mode points the dataset params to the synthetic dataset
+    print "CREATING SYNTHETIC DATASET...",
+    makeSyntheticDataset(BENCHMARK_PATH)
+    print "DONE!"
+    DATASET_PATH = BENCHMARK_PATH + 'train/'
+    NOISE_PATH = BENCHMARK_PATH + 'noise/'
+    DATASET_INDEX = BENCHMARK_PATH + 'dataset_index.pkl'
+    SHARD_PATH = BENCHMARK_PATH + 'shard/'
+    PRETRAINED_MODEL = None
+
+    #results should not depend on the selection params of the local training config
+    AUDIO_INPUT = False
+    SPLIT_MANIFEST = BENCHMARK_PATH + 'split_manifest.pkl'
+    CLASS_NAMES = []
+    MAX_CLASSES = None
+    CLASS_RANGE = [None, None]
+    SAMPLE_RANGE = [None, None]
+    MAX_SAMPLES = None
+    MAX_VAL_SAMPLES = None
+    loadDataset()
+
+    #one batch of samples, images and targets
+    chunk = TRAIN[:BATCH_SIZE]
+    paths = [path for path, _ in chunk]
+    images = [openImage(path, False) for path in paths]
+    samples = [loadImageAndTarget(sample, False) for sample in chunk]
+    x = np.concatenate([s[0] for s in samples])
+    y = np.concatenate([s[1] for s in samples])
+
+    print "RUNNING BENCHMARKS..."
+    results = OrderedDict()
+
+    #data hot paths
+    benchmarkStage(results, 'openImage', lambda: [openImage(path, False) for path in paths], len(paths))
+    benchmarkStage(results, 'openImage_cached', lambda: [openImage(path, True) for path in paths], len(paths))
+    benchmarkStage(results, 'imageAugmentation', lambda: [imageAugmentation(img.copy()) for img in images], len(images))
+    benchmarkStage(results, 'imageBatchAugmentation', lambda: imageBatchAugmentation(x.copy()), x.shape[0])
+    benchmarkStage(results, 'loadImageAndTarget', lambda: [loadImageAndTarget(sample) for sample in chunk], len(chunk))
+    benchmarkStage(results, 'getAugmentedBatches', lambda: getAugmentedBatches(x.copy(), y.copy()), x.shape[0])
+    benchmarkStage(results, 'loadBatch', lambda: loadBatch((chunk, True, MULTI_LABEL, [RANDOM_SEED, 0], 0)), len(chunk))
+    benchmarkStage(results, 'getNextImageBatch', lambda: sum([1 for batch in getNextImageBatch(TRAIN)]), len(TRAIN), 1)
+
+    #confusion matrix updates
+    clearConfusionMatrix()
+    p = RANDOM.random_sample(y.shape).astype('float32')
+    benchmarkStage(results, 'updateConfusionMatrix', lambda: updateConfusionMatrix(p, y), y.shape[0])
+
+    #train and test steps of every model type (compile time is not part of the results)
+    lr = np.float32(LEARNING_RATE[LEARNING_RATE.keys()[0]])
+    for mtype in BENCHMARK_MODEL_TYPES:
+        resetModel(mtype)
+        train_net = getTrainFunction()
+        test_net = getTestFunction()
+        benchmarkStage(results, 'train_net_model_' + str(mtype), lambda: train_net(x, y, lr), x.shape[0])
+        benchmarkStage(results, 'test_net_model_' + str(mtype), lambda: test_net(x, y), x.shape[0])
+
+    #results with the config they depend on
+    report = {'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+              'config':{'batch_size':BATCH_SIZE,
+                        'im_size':list(IM_SIZE),
+                        'im_dim':IM_DIM,
+                        'classes':NUM_CLASSES,
+                        'train_samples':len(TRAIN),
+                        'audio_input':AUDIO_INPUT,
+                        'split_manifest':SPLIT_MANIFEST if os.path.exists(SPLIT_MANIFEST) else None,
+                        'class_names':CLASS_NAMES,
+                        'max_classes':MAX_CLASSES,
+                        'class_range':CLASS_RANGE,
+                        'sample_range':SAMPLE_RANGE,
+                        'max_samples':MAX_SAMPLES,
+                        'max_val_samples':MAX_VAL_SAMPLES,
+                        'num_workers':NUM_WORKERS,
+                        'vectorized_augmentation':VECTORIZED_AUGMENTATION,
+                        'multi_label':MULTI_LABEL,
+                        'device':theano.config.device,
+                        'floatX':theano.config.floatX},
+              'results':results}
+    filename = BENCHMARK_PATH + 'benchmark_' + RUN_NAME + '_' + time.strftime('%Y%m%d_%H%M%S') + '.json'
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print "BENCHMARK RESULTS SAVED TO", filename
+
+    return report
+
+################### VALIDATION SPLIT ####################
+#Specify source folder with sorted training data (one subfolder per species and class id)
+#Use birdCLEF_sort_data.py in order to sort wav files accordingly
+train_path = 'dataset/train/src/'
+
+#we do not move any files, the split manifest lists the validation recordings of every class
+#all spectrograms (or audio chunks) of a recording end up in the same split
+def loadSplitManifest():
+
+    if os.path.exists(SPLIT_MANIFEST):
+        with open(SPLIT_MANIFEST, 'rb') as f:
+            return pickle.load(f)
+    else:
+        return None
+
+def isValidationSample(path, c, manifest):
+
+    #recordings are listed as <class>/<file name without extension>
+    name = os.path.splitext(os.path.basename(path.rsplit('@', 1)[0]))[0]
+    if c + '/' + name in manifest['val']:
+        return True
+
+    #spectrogram images are named <recording>_<spec number>
+    return '_' in name and c + '/' + name.rsplit('_', 1)[0] in manifest['val']
+
+def splitDataset():
+
+    #folder listings come from the dataset index, so this is fast even for large datasets
+    index = loadDatasetIndex()
+    classes, changed = scanFolder(index, train_path)
+
+    #get files for classes
+    val = set()
+    for c in classes:
+        files, c_changed = scanFolder(index, os.path.join(train_path, c))
+        changed = changed or c_changed
+
+        #shuffle files
+        files = shuffle(files, random_state=1337)
+
+        #choose amount of files for validation split from each class
+        #we want at least 1 sample per class (2 if sample count os between 12 and 20)
+        #we take SPLIT_RATIO of the samples if sample count > 20
+        if len(files) <= 12:
+            num_test_files = 1
+        elif len(files) > 12 and len(files) <= 20:
+            num_test_files = 2
+        else:
+            num_test_files = int(len(files) * SPLIT_RATIO)
+
+        test_files = files[:num_test_files]
+        print c, len(files), len(test_files)
+
+        val.update([c + '/' + os.path.splitext(f)[0] for f in test_files])
+
+    if changed:
+        saveDatasetIndex(index)
+
+    #write to temp file first, a killed process should not leave a broken manifest
+    if not os.path.exists(os.path.dirname(SPLIT_MANIFEST)):
+        os.makedirs(os.path.dirname(SPLIT_MANIFEST))
+    with open(SPLIT_MANIFEST + '.tmp', 'wb') as f:
+        pickle.dump({'ratio':SPLIT_RATIO, 'val':val}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(SPLIT_MANIFEST + '.tmp', SPLIT_MANIFEST)
+
+    print "VALIDATION RECORDINGS:", len(val), "SAVED TO", SPLIT_MANIFEST
+
+######################## MAIN ###########################
+if __name__ == '__main__':
+
+    if MODE == 'train':
+        train()
+    elif MODE == 'finetune':
+        finetuneHead()
+    elif MODE == 'predict':
+        predictFiles(INFERENCE_FILES)
+    elif MODE == 'score':
+        scoreCorpus()
+    elif MODE == 'embed':
+        buildEmbeddingIndex()
+    elif MODE == 'serve':
+        serve()
+    elif MODE == 'export':
+        exportInferenceModel()
+    elif MODE == 'tta':
+        evaluateTTA()
+    elif MODE == 'benchmark':
+        runBenchmarks()
+    elif MODE == 'split':
+        splitDataset()